@@ -0,0 +1,197 @@
+"""Бенчмарк запуска бота.
+
+1. Разбивка `python -X importtime -c "import download"` по модулям верхнего уровня.
+2. Время до первого апдейта: бот запускается против локальной заглушки Bot API
+   (TELEGRAM_API_BASE_URL), которая отдаёт одно сообщение /help и ждёт ответ sendMessage.
+
+Запуск: python bench_startup.py [--runs 3] [--top 15] > bench_output.txt
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKE_TOKEN = "123456:bench"
+
+
+def _bench_env(**extra) -> dict:
+    env = dict(os.environ)
+    env.setdefault("BOT_TOKEN", FAKE_TOKEN)
+    env.setdefault("DOWNLOAD_FOLDER", os.path.join(HERE, "downloads"))
+    env.update(extra)
+    return env
+
+
+def import_time_breakdown(top: int) -> tuple[float, list[tuple[int, int, str]]]:
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import download"],
+        cwd=HERE,
+        env=_bench_env(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    rows = []
+    total_us = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3:
+            continue
+        self_us, cumulative_us, name = int(parts[0]), int(parts[1]), parts[2]
+        if name.strip() == "download":
+            total_us = cumulative_us
+        # Модули, импортированные непосредственно download.py (одна ступень вложенности)
+        depth = (len(name) - len(name.lstrip(" "))) // 2
+        if depth == 1:
+            rows.append((self_us, cumulative_us, name.strip()))
+
+    rows.sort(key=lambda r: r[1], reverse=True)
+    return total_us / 1e6, rows[:top]
+
+
+class _FakeBotApi(BaseHTTPRequestHandler):
+    """Минимальная заглушка Bot API: одно входящее сообщение и приём ответов"""
+
+    first_update_sent = False
+    polling_started_at = None
+    replied_at = None
+    replied = threading.Event()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, result):
+        body = json.dumps({"ok": True, "result": result}).encode("utf-8")
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # Бот уже остановлен, пока висел long polling
+            pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        method = self.path.rsplit("/", 1)[-1]
+        cls = type(self)
+
+        if method == "getMe":
+            self._reply({
+                "id": 123456,
+                "is_bot": True,
+                "first_name": "bench",
+                "username": "bench_bot",
+                "can_join_groups": True,
+                "can_read_all_group_messages": False,
+                "supports_inline_queries": True,
+            })
+        elif method == "getUpdates":
+            if cls.polling_started_at is None:
+                cls.polling_started_at = time.monotonic()
+            if not cls.first_update_sent:
+                cls.first_update_sent = True
+                self._reply([{
+                    "update_id": 1,
+                    "message": {
+                        "message_id": 1,
+                        "date": int(time.time()),
+                        "chat": {"id": 1, "type": "private"},
+                        "from": {"id": 1, "is_bot": False, "first_name": "bench"},
+                        "text": "/help",
+                        "entities": [{"type": "bot_command", "offset": 0, "length": 5}],
+                    },
+                }])
+            else:
+                time.sleep(0.2)
+                self._reply([])
+        elif method == "sendMessage":
+            if cls.replied_at is None:
+                cls.replied_at = time.monotonic()
+                cls.replied.set()
+            self._reply({
+                "message_id": 2,
+                "date": int(time.time()),
+                "chat": {"id": 1, "type": "private"},
+                "text": "ok",
+            })
+        else:
+            self._reply(True)
+
+
+def time_to_first_update(timeout: float) -> dict:
+    handler = type("_Handler", (_FakeBotApi,), {"replied": threading.Event()})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    started_at = time.monotonic()
+    proc = subprocess.Popen(
+        [sys.executable, "download.py"],
+        cwd=HERE,
+        env=_bench_env(TELEGRAM_API_BASE_URL=base_url, WARMUP_DELAY_SECONDS="0"),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        if not handler.replied.wait(timeout):
+            raise RuntimeError("bot did not answer the first update in time")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        server.shutdown()
+
+    return {
+        "polling_started": handler.polling_started_at - started_at,
+        "first_reply": handler.replied_at - started_at,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    totals = []
+    rows = []
+    for _ in range(max(1, args.runs)):
+        total, rows = import_time_breakdown(args.top)
+        totals.append(total)
+
+    print(f"import download: median {statistics.median(totals):.3f} s over {len(totals)} run(s)")
+    print(f"{'self, ms':>10} {'cumulative, ms':>15}  module")
+    for self_us, cumulative_us, name in rows:
+        print(f"{self_us / 1000:>10.1f} {cumulative_us / 1000:>15.1f}  {name}")
+
+    polling = []
+    replies = []
+    for _ in range(max(1, args.runs)):
+        result = time_to_first_update(args.timeout)
+        polling.append(result["polling_started"])
+        replies.append(result["first_reply"])
+
+    print()
+    print(f"process start -> polling started:   median {statistics.median(polling):.3f} s")
+    print(f"process start -> first update reply: median {statistics.median(replies):.3f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""Пакетное скачивание без Telegram (бэкфиллы, архивы).
+
+Ссылки Instagram/TikTok читаются из файла или stdin (по одной или несколько в строке)
+и скачиваются тем же движком, что и в боте, под теми же лимитами: общий лимит
+MAX_INFLIGHT_DOWNLOADS, INSTAGRAM_MAX_CONCURRENT и пауза INSTAGRAM_COOLDOWN_SECONDS
+между запусками скачиваний из Instagram.
+
+Результат каждой ссылки дописывается строкой в JSONL-манифест сразу по завершении.
+Ссылки, уже записанные в манифест, при повторном запуске пропускаются — прерванный
+прогон можно просто запустить снова.
+
+Запуск: python bulk_download.py urls.txt [--manifest bulk_manifest.jsonl] [--out archive]
+        cat urls.txt | python bulk_download.py - --jobs 2 --retry-failed
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+from pathlib import Path
+
+import download
+
+
+def _read_urls(source) -> list[str]:
+    """Ссылки из входа без дубликатов (ключ — как у кэша бота), в порядке появления"""
+    urls = []
+    seen = set()
+    for line in source:
+        for url in download.URL_PATTERN.finditer(line):
+            url = download._normalize_url(url.group(0))
+            key = download._media_cache_key(url)
+            if key in seen:
+                continue
+            seen.add(key)
+            urls.append(url)
+    return urls
+
+
+def _load_manifest(path: str, retry_failed: bool) -> set[str]:
+    """Ключи ссылок, которые уже есть в манифесте (с --retry-failed — только успешные)"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Оборванная последняя строка после аварийной остановки
+                continue
+            if retry_failed and record.get("status") != "ok":
+                continue
+            done.add(record.get("key"))
+    return done
+
+
+def _store_files(paths: list[str], out_dir: Path, key: str) -> list[str]:
+    """Переносит скачанное из DOWNLOAD_FOLDER в каталог архива: <out>/<hash ключа>/<имя>"""
+    if not paths:
+        return []
+    target = out_dir / hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+    target.mkdir(parents=True, exist_ok=True)
+    stored = []
+    for path in paths:
+        dest = target / os.path.basename(path)
+        shutil.move(path, dest)
+        stored.append(str(dest))
+    return stored
+
+
+class _InstagramGate:
+    """Пауза между запусками скачиваний из Instagram, как кулдаун в боте"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = asyncio.Lock()
+        self._last = 0.0
+
+    async def wait(self):
+        async with self._lock:
+            delay = self._last + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._last = time.monotonic()
+
+
+async def _process(url: str, args, admission, ig_gate: _InstagramGate, manifest) -> dict:
+    key = download._media_cache_key(url)
+    job_class = download._job_class(url)
+    record = {"url": url, "key": key, "platform": job_class}
+
+    with download._trace("bulk", url=url):
+        queued_at = time.monotonic()
+        async with admission.slot(("bulk", job_class), job_class):
+            if job_class == "instagram":
+                await ig_gate.wait()
+            started_at = time.monotonic()
+            record["queued_s"] = round(started_at - queued_at, 3)
+            try:
+                paths, _ = await download._download_media(url)
+                files = await asyncio.to_thread(_store_files, paths, Path(args.out), key)
+                record["status"] = "ok" if files else "failed"
+                record["files"] = files
+                record["bytes"] = sum(os.path.getsize(p) for p in files)
+                if not files:
+                    record["failure"] = download._negative_cache_get(url) or download.FAILURE_TRANSIENT
+            except Exception as e:
+                download.logger.exception("Bulk download failed for %s", url)
+                record["status"] = "failed"
+                record["failure"] = download.FAILURE_TRANSIENT
+                record["error"] = f"{type(e).__name__}: {e}"
+            record["duration_s"] = round(time.monotonic() - started_at, 3)
+
+    record["finished_at"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    # Строка манифеста пишется сразу: прерванный прогон продолжится с этого места
+    manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+    manifest.flush()
+    print(f"{record['status']:>6}  {record['duration_s']:>7.1f} s  {url}", flush=True)
+    return record
+
+
+async def _run(args) -> int:
+    if args.input == "-":
+        urls = _read_urls(sys.stdin)
+    else:
+        with open(args.input, encoding="utf-8") as f:
+            urls = _read_urls(f)
+
+    done = _load_manifest(args.manifest, args.retry_failed)
+    pending = [u for u in urls if download._media_cache_key(u) not in done]
+    print(f"{len(urls)} url(s), {len(urls) - len(pending)} already in manifest, {len(pending)} to download")
+    if not pending:
+        return 0
+
+    admission = download._AdmissionQueue(
+        max_inflight=args.jobs,
+        class_limits={"instagram": download.INSTAGRAM_MAX_CONCURRENT},
+        weights={},
+        job_seconds=download.ADMISSION_JOB_SECONDS,
+    )
+    ig_gate = _InstagramGate(args.ig_interval)
+
+    # Ограниченный пул обработчиков вместо задачи на каждую ссылку: в очереди допуска
+    # одновременно не больше задач, чем обработчиков. У Instagram свой пул по его лимиту,
+    # чтобы ссылки TikTok не простаивали за ссылками, ждущими слота Instagram.
+    queues = {"instagram": asyncio.Queue(), "tiktok": asyncio.Queue()}
+    for url in pending:
+        queues[download._job_class(url)].put_nowait(url)
+    workers = {
+        "instagram": min(args.jobs, download.INSTAGRAM_MAX_CONCURRENT),
+        "tiktok": args.jobs,
+    }
+    results = []
+
+    async def _worker(queue: asyncio.Queue):
+        while True:
+            try:
+                url = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            results.append(await _process(url, args, admission, ig_gate, manifest))
+
+    started_at = time.monotonic()
+    with open(args.manifest, "a", encoding="utf-8") as manifest:
+        await asyncio.gather(*(
+            _worker(queues[job_class])
+            for job_class, count in workers.items()
+            for _ in range(min(max(1, count), queues[job_class].qsize()))
+        ))
+
+    ok = sum(1 for r in results if r["status"] == "ok")
+    print(f"done: {ok} ok, {len(results) - ok} failed in {time.monotonic() - started_at:.1f} s")
+    return 0 if ok == len(results) else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", nargs="?", default="-", help="файл со ссылками или - для stdin")
+    parser.add_argument("--manifest", default="bulk_manifest.jsonl")
+    parser.add_argument("--out", default="archive", help="каталог для скачанных файлов")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=download.MAX_INFLIGHT_DOWNLOADS,
+        help="сколько ссылок скачивается одновременно",
+    )
+    parser.add_argument(
+        "--ig-interval",
+        type=float,
+        default=download.INSTAGRAM_COOLDOWN_SECONDS,
+        help="пауза между скачиваниями из Instagram, сек",
+    )
+    parser.add_argument("--retry-failed", action="store_true", help="повторить ссылки, записанные как failed")
+    args = parser.parse_args()
+    args.jobs = max(1, args.jobs)
+
+    try:
+        sys.exit(asyncio.run(_run(args)))
+    except KeyboardInterrupt:
+        print("interrupted; run again to resume from the manifest", file=sys.stderr)
+        sys.exit(130)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,39 +1,94 @@
+import time
+
+# Момент старта процесса (для метрик времени запуска)
+_STARTED_AT = time.monotonic()
+
 import os
 import re
 import logging
-import time
 import random
 import asyncio
 import html
 import http.cookiejar
 import json
-
+import hashlib
+import datetime as dt
+import threading
+import functools
+import heapq
+import itertools
+import math
+import contextlib
+import sqlite3
+import atexit
+import queue
+import shutil
+import struct
+import subprocess
+import sys
+import traceback
+
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
 from pathlib import Path
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram import (
+    Update,
+    Chat,
+    Message,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    BotCommand,
+    BotCommandScopeChat,
+    InlineQueryResultArticle,
+    InlineQueryResultCachedDocument,
+    InlineQueryResultCachedMpeg4Gif,
+    InlineQueryResultCachedPhoto,
+    InlineQueryResultCachedVideo,
+    InputTextMessageContent,
+    InputMediaAnimation,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+)
+from telegram.ext import (
+    Application,
+    CommandHandler,
+    MessageHandler,
+    CallbackQueryHandler,
+    InlineQueryHandler,
+    ChosenInlineResultHandler,
+    BaseRateLimiter,
+    TypeHandler,
+    filters,
+    ContextTypes,
+)
+from telegram.error import RetryAfter
+
+# yt-dlp, requests и Pillow импортируются лениво (при первом использовании или в фоновом
+# прогреве после запуска бота) — на старт они тратят больше времени, чем весь остальной модуль
 
-import yt_dlp
-import requests
+from urllib.parse import urlparse, urlencode, parse_qsl, urlunparse
+from dotenv import load_dotenv
 
-from yt_dlp.utils import DownloadError
+# Текущая трассировка запроса: (trace_id, отобрана ли для экспорта спанов)
+_trace_ctx: ContextVar = ContextVar("trace", default=None)
 
-try:
-    from PIL import Image
 
-    _PIL_AVAILABLE = True
-except Exception:
-    Image = None
-    _PIL_AVAILABLE = False
+def _trace_log_filter(record: logging.LogRecord) -> bool:
+    trace = _trace_ctx.get()
+    record.trace_id = trace[0] if trace else "-"
+    return True
 
-from urllib.parse import urlparse, urlencode, parse_qsl, urlunparse
-from dotenv import load_dotenv
 
 # Настройка логирования
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s',
     level=logging.INFO
 )
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(_trace_log_filter)
 logger = logging.getLogger(__name__)
 
 logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -48,15 +103,111 @@ load_dotenv()
 DOWNLOAD_FOLDER = os.getenv("DOWNLOAD_FOLDER", "downloads")
 Path(DOWNLOAD_FOLDER).mkdir(exist_ok=True)
 
-# Токен вашего бота читаем из переменной окружения
+# Токен вашего бота читаем из переменной окружения (проверяется в main)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
-if not BOT_TOKEN:
-    raise RuntimeError("BOT_TOKEN is not set. Please set it in .env or as an environment variable.")
+# Свой Bot API сервер (например, локальный telegram-bot-api), по умолчанию — api.telegram.org
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")
+
+# Задержка фонового прогрева тяжёлых импортов после запуска (отрицательное значение — выключить)
+WARMUP_DELAY_SECONDS = float(os.getenv("WARMUP_DELAY_SECONDS", "1"))
 
 INSTAGRAM_COOLDOWN_SECONDS = int(os.getenv("INSTAGRAM_COOLDOWN_SECONDS", "30"))
 INSTAGRAM_MAX_CONCURRENT = int(os.getenv("INSTAGRAM_MAX_CONCURRENT", "1"))
-_instagram_semaphore = asyncio.Semaphore(max(1, INSTAGRAM_MAX_CONCURRENT))
+
+# Сколько ссылок из одного сообщения обрабатываем и сколько из них параллельно на пользователя
+MAX_LINKS_PER_MESSAGE = int(os.getenv("MAX_LINKS_PER_MESSAGE", "10"))
+USER_MAX_CONCURRENT = int(os.getenv("USER_MAX_CONCURRENT", "2"))
+_user_semaphores: dict[int, asyncio.Semaphore] = {}
+# Сколько пакетов пользователя сейчас пользуются его семафором; без пакетов запись удаляется
+_user_semaphore_refs: dict[int, int] = {}
+
+# Допуск задач: сколько скачиваний идёт одновременно на весь бот (Instagram дополнительно
+# ограничен INSTAGRAM_MAX_CONCURRENT), очередь между пользователями — взвешенная справедливая.
+# Если оценка ожидания в очереди больше ADMISSION_MAX_WAIT_SECONDS, сообщение отклоняется
+# с просьбой повторить позже (0 — не отклонять). ADMISSION_JOB_SECONDS — начальная оценка
+# длительности одной задачи, дальше она уточняется по факту.
+MAX_INFLIGHT_DOWNLOADS = int(os.getenv("MAX_INFLIGHT_DOWNLOADS", "4"))
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "300"))
+ADMISSION_JOB_SECONDS = float(os.getenv("ADMISSION_JOB_SECONDS", "20"))
+# Сколько апдейтов Telegram обрабатывается параллельно (1 — строго по очереди)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "256"))
+
+# Кэш file_id уже отправленных медиа: повторные ссылки и inline-запросы отдаём без скачивания
+SENT_MEDIA_CACHE_SIZE = int(os.getenv("SENT_MEDIA_CACHE_SIZE", "1000"))
+# Чат (например, приватный канал), куда бот загружает медиа для inline-режима.
+# Если не задан, загружаем в личный чат пользователя и сразу удаляем сообщение.
+INLINE_CACHE_CHAT_ID = os.getenv("INLINE_CACHE_CHAT_ID")
+
+# Негативный кэш: приватные/удалённые ссылки не скачиваем повторно в течение TTL (0 — выключить).
+# login_required держим меньше — причиной могут быть устаревшие cookies.
+NEGATIVE_CACHE_TTL_SECONDS = int(os.getenv("NEGATIVE_CACHE_TTL_SECONDS", "3600"))
+NEGATIVE_CACHE_LOGIN_TTL_SECONDS = int(os.getenv("NEGATIVE_CACHE_LOGIN_TTL_SECONDS", "300"))
+NEGATIVE_CACHE_SIZE = int(os.getenv("NEGATIVE_CACHE_SIZE", "5000"))
+
+# Прогресс скачивания в статус-сообщении: не чаще одного редактирования за N секунд на чат
+PROGRESS_EDIT_INTERVAL_SECONDS = float(os.getenv("PROGRESS_EDIT_INTERVAL_SECONDS", "3"))
+
+# Журнал задач (SQLite): незавершённые после перезапуска задачи запускаются снова.
+# Пустое значение JOB_JOURNAL_PATH выключает журнал.
+JOB_JOURNAL_PATH = os.getenv("JOB_JOURNAL_PATH", os.path.join(DOWNLOAD_FOLDER, "jobs.sqlite3"))
+JOB_MAX_REPLAYS = int(os.getenv("JOB_MAX_REPLAYS", "3"))
+
+# Пул готовых экземпляров YoutubeDL: сколько держать про запас на идентичность,
+# после скольких скачиваний и через сколько секунд пересоздавать
+YTDLP_POOL_SIZE = int(os.getenv("YTDLP_POOL_SIZE", "2"))
+YTDLP_POOL_MAX_USES = int(os.getenv("YTDLP_POOL_MAX_USES", "50"))
+YTDLP_POOL_MAX_AGE_SECONDS = float(os.getenv("YTDLP_POOL_MAX_AGE_SECONDS", "1800"))
+
+# Сегментированное скачивание больших файлов: параллельные Range-запросы.
+# Число соединений на хост привязано к платформе (Instagram строже, чем TikTok).
+DOWNLOAD_CONNECTIONS_INSTAGRAM = int(os.getenv("DOWNLOAD_CONNECTIONS_INSTAGRAM", "2"))
+DOWNLOAD_CONNECTIONS_TIKTOK = int(os.getenv("DOWNLOAD_CONNECTIONS_TIKTOK", "4"))
+DOWNLOAD_CONNECTIONS_DEFAULT = int(os.getenv("DOWNLOAD_CONNECTIONS_DEFAULT", "4"))
+SEGMENTED_MIN_SIZE = int(float(os.getenv("SEGMENTED_MIN_SIZE_MB", "4")) * 1024 * 1024)
+SEGMENTED_SEGMENT_SIZE = int(float(os.getenv("SEGMENTED_SEGMENT_SIZE_MB", "2")) * 1024 * 1024)
+SEGMENTED_RETRIES = int(os.getenv("SEGMENTED_RETRIES", "4"))
+
+# Подготовка видео перед отправкой (нужны ffmpeg и ffprobe в PATH или FFMPEG_PATH/FFPROBE_PATH):
+# faststart-перепаковка без перекодирования, длительность, размеры и превью для send_video
+VIDEO_POSTPROCESS = os.getenv("VIDEO_POSTPROCESS", "1").strip() not in ("0", "false", "False")
+VIDEO_POSTPROCESS_WORKERS = int(os.getenv("VIDEO_POSTPROCESS_WORKERS", "2"))
+VIDEO_POSTPROCESS_TIMEOUT_SECONDS = float(os.getenv("VIDEO_POSTPROCESS_TIMEOUT_SECONDS", "120"))
+FFMPEG_PATH = os.getenv("FFMPEG_PATH")
+FFPROBE_PATH = os.getenv("FFPROBE_PATH")
+
+# Трассировка запросов: TRACE_EXPORT=jsonl (файл TRACE_JSONL_PATH) или otlp (OTLP/HTTP JSON
+# на TRACE_OTLP_ENDPOINT); пусто — спаны не пишутся, trace id в логах остаётся.
+# TRACE_SAMPLE_RATE — доля входящих запросов, для которых пишутся спаны (0..1).
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "").strip().lower()
+TRACE_JSONL_PATH = os.getenv("TRACE_JSONL_PATH", os.path.join(DOWNLOAD_FOLDER, "traces.jsonl"))
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://127.0.0.1:4318/v1/traces")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "media-download-bot")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+
+# Сторож event loop: как часто мерить задержку планирования и с какой задержки писать
+# предупреждение (LOOP_LAG_INTERVAL_SECONDS=0 — выключить). LOOP_DEBUG=1 дополнительно
+# снимает стек вызова, занявшего loop дольше LOOP_BLOCK_THRESHOLD_SECONDS.
+# Сводка пишется в лог раз в LOOP_METRICS_LOG_SECONDS и, если задан, в JSON-файл LOOP_METRICS_PATH.
+LOOP_LAG_INTERVAL_SECONDS = float(os.getenv("LOOP_LAG_INTERVAL_SECONDS", "0.5"))
+LOOP_LAG_WARN_SECONDS = float(os.getenv("LOOP_LAG_WARN_SECONDS", "0.25"))
+LOOP_DEBUG = os.getenv("LOOP_DEBUG", "0").strip() not in ("0", "false", "False")
+LOOP_BLOCK_THRESHOLD_SECONDS = float(os.getenv("LOOP_BLOCK_THRESHOLD_SECONDS", "0.1"))
+LOOP_METRICS_LOG_SECONDS = float(os.getenv("LOOP_METRICS_LOG_SECONDS", "300"))
+LOOP_METRICS_PATH = os.getenv("LOOP_METRICS_PATH")
+
+# Администраторы бота (id пользователей через запятую): им доступна команда /profile,
+# которая на N секунд включает сэмплирующий профайлер и присылает профиль файлом
+ADMIN_USER_IDS = {int(x) for x in os.getenv("ADMIN_USER_IDS", "").replace(" ", "").split(",") if x.isdigit()}
+PROFILER_DEFAULT_SECONDS = float(os.getenv("PROFILER_DEFAULT_SECONDS", "30"))
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "300"))
+PROFILER_INTERVAL_SECONDS = float(os.getenv("PROFILER_INTERVAL_SECONDS", "0.01"))
+
+# Лимиты исходящих запросов к Telegram (запросов в секунду; для групп — в минуту)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GROUP_RATE_PER_MINUTE = float(os.getenv("TELEGRAM_GROUP_RATE_PER_MINUTE", "20"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "5"))
 
 TELEGRAM_SEND_INSTAGRAM_IMAGES_AS_DOCUMENT = os.getenv("TELEGRAM_SEND_INSTAGRAM_IMAGES_AS_DOCUMENT", "0").strip() not in (
     "0",
@@ -125,6 +276,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Максимальный размер: 50 МБ (ограничение Telegram)
 • Приватные видео не скачиваются
 • Могут быть проблемы с некоторыми аккаунтами
+• Inline-режим: напишите @имя_бота и ссылку в любом чате
 """
     else:
         help_text = """
@@ -141,6 +293,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Max file size: 50 MB (Telegram limit)
 • Private videos cannot be downloaded
 • Some accounts or links may not work
+• Inline mode: type @bot_username and a link in any chat
 """
 
     await update.message.reply_text(help_text, parse_mode='Markdown')
@@ -200,7 +353,372 @@ def _unescape_jsonish_url(s: str) -> str:
     return s
 
 
-def _extract_display_urls_from_html(page_url: str, cookiejar: http.cookiejar.CookieJar | None = None) -> list[str]:
+def _media_cache_key(url: str) -> str:
+    parsed = urlparse(_normalize_url(url))
+    return parsed.netloc.lower().removeprefix("www.") + parsed.path.rstrip('/')
+
+
+# ========== НЕГАТИВНЫЙ КЭШ ==========
+
+FAILURE_PRIVATE = "private"
+FAILURE_NOT_FOUND = "not_found"
+FAILURE_LOGIN_REQUIRED = "login_required"
+FAILURE_TRANSIENT = "transient"
+
+_PERMANENT_FAILURES = {FAILURE_PRIVATE, FAILURE_NOT_FOUND, FAILURE_LOGIN_REQUIRED}
+
+# ключ ссылки -> (тип ошибки, время истечения)
+_negative_cache: OrderedDict[str, tuple[str, float]] = OrderedDict()
+_negative_cache_lock = threading.Lock()
+
+
+def _failure_status_code(err) -> int | None:
+    response = getattr(err, "response", None)
+    status = getattr(response, "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+# Исключения таймаутов и обрывов соединения (requests, urllib3, socket) — по имени класса,
+# чтобы не импортировать requests ради isinstance
+_TRANSIENT_ERROR_TYPES = {
+    "Timeout", "ConnectTimeout", "ReadTimeout", "TimeoutError", "timeout",
+    "ConnectionError", "ConnectionResetError", "ChunkedEncodingError", "ProtocolError",
+}
+
+# Точные фразы yt-dlp и страниц Instagram/TikTok об удалённой или несуществующей публикации.
+# Голые "unavailable"/"not available" сюда не подходят: так пишут и 503 Service Unavailable,
+# и "Requested format is not available".
+_NOT_FOUND_PHRASES = [
+    "video not available",
+    "video unavailable",
+    "this video is unavailable",
+    "this post is unavailable",
+    "page isn't available",
+    "page is not available",
+    "post isn't available",
+    "content isn't available",
+    "no longer available",
+    "post not found",
+    "video not found",
+    "page not found",
+    "has been removed",
+    "has been deleted",
+    "does not exist",
+    "doesn't exist",
+]
+
+
+def _is_transient_error(err) -> bool:
+    return any(cls.__name__ in _TRANSIENT_ERROR_TYPES for cls in type(err).__mro__)
+
+
+def _classify_failure(errors: list) -> str:
+    """Классификация причин неудачи по собранным ошибкам/заметкам"""
+    statuses = {s for s in (_failure_status_code(e) for e in errors) if s}
+    text = " | ".join(str(e) for e in errors).lower()
+
+    # Rate-limit маскирует настоящую причину (yt-dlp пишет "rate-limit reached or login required")
+    if 429 in statuses or re.search(r'\b429\b', text) or any(
+        x in text for x in ["rate-limit", "rate limit", "too many requests"]
+    ):
+        return FAILURE_TRANSIENT
+    # Ошибки сервера и сети временные, какие бы слова ни были в тексте
+    if any(s >= 500 for s in statuses) or re.search(r'\b5\d\d (server error|service unavailable)', text):
+        return FAILURE_TRANSIENT
+    if any(_is_transient_error(e) for e in errors if isinstance(e, BaseException)) or any(
+        x in text for x in ["timed out", "timeout", "connection reset", "connection aborted", "temporarily"]
+    ):
+        return FAILURE_TRANSIENT
+    if "private" in text:
+        return FAILURE_PRIVATE
+    if 404 in statuses or 410 in statuses or re.search(r'\b(404|410)\b', text) or any(
+        x in text for x in _NOT_FOUND_PHRASES
+    ):
+        return FAILURE_NOT_FOUND
+    if 401 in statuses or any(
+        x in text for x in ["login required", "log in", "/accounts/login", "/challenge/", "authentication"]
+    ):
+        return FAILURE_LOGIN_REQUIRED
+    return FAILURE_TRANSIENT
+
+
+def _negative_cache_get(url: str) -> str | None:
+    key = _media_cache_key(url)
+    with _negative_cache_lock:
+        entry = _negative_cache.get(key)
+        if entry is None:
+            return None
+        kind, expires_at = entry
+        if expires_at <= time.time():
+            _negative_cache.pop(key, None)
+            return None
+        return kind
+
+
+def _remember_failure(url: str, errors: list) -> str:
+    kind = _classify_failure(errors)
+    logger.info("Failure for %s classified as %s", url, kind)
+
+    ttl = NEGATIVE_CACHE_LOGIN_TTL_SECONDS if kind == FAILURE_LOGIN_REQUIRED else NEGATIVE_CACHE_TTL_SECONDS
+    if kind not in _PERMANENT_FAILURES or ttl <= 0:
+        return kind
+
+    key = _media_cache_key(url)
+    with _negative_cache_lock:
+        _negative_cache[key] = (kind, time.time() + ttl)
+        _negative_cache.move_to_end(key)
+        while len(_negative_cache) > NEGATIVE_CACHE_SIZE:
+            _negative_cache.popitem(last=False)
+    return kind
+
+
+# ========== ПРОГРЕСС СКАЧИВАНИЯ ==========
+
+# Репортёр прогресса текущего запроса: (скачано байт, всего байт | None, скорость байт/с | None).
+# asyncio.to_thread копирует контекст, поэтому значение видно и в рабочем потоке.
+_progress_reporter: ContextVar = ContextVar("progress_reporter", default=None)
+
+
+def _report_progress(downloaded: int, total: int | None = None, speed: float | None = None):
+    reporter = _progress_reporter.get()
+    if reporter is None:
+        return
+    try:
+        reporter(downloaded, total, speed)
+    except Exception as e:
+        logger.debug("Progress reporter failed: %s", e)
+
+
+def _ytdlp_progress_hook(d: dict):
+    if d.get("status") != "downloading":
+        return
+    _report_progress(
+        d.get("downloaded_bytes") or 0,
+        d.get("total_bytes") or d.get("total_bytes_estimate"),
+        d.get("speed"),
+    )
+
+
+def _format_progress(downloaded: int, total: int | None, speed: float | None) -> str:
+    mb = 1024 * 1024
+    if total:
+        text = f"{min(100, int(downloaded * 100 / total))}% из {total / mb:.1f} МБ"
+    else:
+        text = f"{downloaded / mb:.1f} МБ"
+    if speed:
+        text += f" ({speed / mb:.1f} МБ/с)"
+    return text
+
+
+# ========== ТРАССИРОВКА ==========
+# Trace id живёт в _trace_ctx (см. настройку логирования) и попадает в каждую строку лога.
+# Спаны пишутся только для отобранных трассировок (TRACE_SAMPLE_RATE) и при включённом экспорте.
+# asyncio.to_thread копирует контекст, для своих пулов потоков контекст копируем явно.
+
+# Текущий спан (родитель для вложенных)
+_span_ctx: ContextVar = ContextVar("span", default=None)
+
+
+class _Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attrs", "start_ns", "status", "error")
+
+    def __init__(self, trace_id: str, parent_id: str | None, name: str, attrs: dict):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = {k: v for k, v in attrs.items() if v is not None}
+        self.start_ns = time.time_ns()
+        self.status = "ok"
+        self.error = None
+
+    def set(self, **attrs):
+        self.attrs.update((k, v) for k, v in attrs.items() if v is not None)
+
+
+class _NoopSpan:
+    """Спан неотобранной трассировки: атрибуты никуда не пишутся"""
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _SpanExporter:
+    """Фоновая выгрузка спанов пачками: в JSONL-файл или OTLP/HTTP (JSON) коллектору"""
+
+    def __init__(self, mode: str, jsonl_path: str, otlp_endpoint: str, service_name: str):
+        self.mode = mode
+        self.jsonl_path = jsonl_path
+        self.otlp_endpoint = otlp_endpoint
+        self.service_name = service_name
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def export(self, record: dict):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                    self._thread.start()
+                    atexit.register(self.flush)
+        self._queue.put(record)
+
+    def _drain(self, first: dict | None, limit: int = 512) -> list[dict]:
+        batch = [first] if first is not None else []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._drain(self._queue.get())
+            self._write(batch)
+            time.sleep(1.0)
+
+    def flush(self):
+        batch = self._drain(None, limit=1 << 30)
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch: list[dict]):
+        try:
+            if self.mode == "otlp":
+                import requests
+
+                requests.post(self.otlp_endpoint, json=self._otlp_payload(batch), timeout=10).raise_for_status()
+            else:
+                with open(self.jsonl_path, 'a', encoding='utf-8') as f:
+                    for record in batch:
+                        f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        except Exception as e:
+            logger.warning("Span export failed (%d spans dropped): %s", len(batch), e)
+
+    @staticmethod
+    def _otlp_value(value) -> dict:
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def _otlp_payload(self, batch: list[dict]) -> dict:
+        spans = []
+        for r in batch:
+            span = {
+                "traceId": r["trace_id"],
+                "spanId": r["span_id"],
+                "name": r["name"],
+                "kind": 1,
+                "startTimeUnixNano": str(r["start_ns"]),
+                "endTimeUnixNano": str(r["end_ns"]),
+                "attributes": [{"key": k, "value": self._otlp_value(v)} for k, v in r["attrs"].items()],
+                "status": {"code": 2, "message": r["error"]} if r["status"] == "error" else {"code": 1},
+            }
+            if r["parent_id"]:
+                span["parentSpanId"] = r["parent_id"]
+            spans.append(span)
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+            }]
+        }
+
+
+_span_exporter = (
+    _SpanExporter(TRACE_EXPORT, TRACE_JSONL_PATH, TRACE_OTLP_ENDPOINT, TRACE_SERVICE_NAME)
+    if TRACE_EXPORT in ("jsonl", "otlp") else None
+)
+
+
+@contextlib.contextmanager
+def _span(name: str, **attrs):
+    """Спан внутри текущей трассировки; вне трассировки или без отбора ничего не делает"""
+    trace = _trace_ctx.get()
+    if trace is None or not trace[1]:
+        yield _NOOP_SPAN
+        return
+
+    parent = _span_ctx.get()
+    span = _Span(trace[0], parent.span_id if parent else None, name, attrs)
+    token = _span_ctx.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.status = "error"
+        span.error = f"{type(e).__name__}: {e}"[:500]
+        raise
+    finally:
+        _span_ctx.reset(token)
+        _span_exporter.export({
+            "trace_id": span.trace_id,
+            "span_id": span.span_id,
+            "parent_id": span.parent_id,
+            "name": span.name,
+            "start_ns": span.start_ns,
+            "end_ns": time.time_ns(),
+            "duration_ms": round((time.time_ns() - span.start_ns) / 1e6, 3),
+            "status": span.status,
+            "error": span.error,
+            "thread": threading.current_thread().name,
+            "attrs": span.attrs,
+        })
+
+
+@contextlib.contextmanager
+def _trace(name: str, **attrs):
+    """Новая трассировка (один входящий запрос) с корневым спаном"""
+    sampled = _span_exporter is not None and random.random() < TRACE_SAMPLE_RATE
+    trace_token = _trace_ctx.set((os.urandom(16).hex(), sampled))
+    span_token = _span_ctx.set(None)
+    try:
+        with _span(name, **attrs) as span:
+            yield span
+    finally:
+        _span_ctx.reset(span_token)
+        _trace_ctx.reset(trace_token)
+
+
+def _traced(name: str):
+    """Декоратор обработчика апдейта: каждый апдейт — своя трассировка"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            chat = getattr(update, "effective_chat", None)
+            user = getattr(update, "effective_user", None)
+            with _trace(
+                name,
+                chat_id=chat.id if chat else None,
+                user_id=user.id if user else None,
+                update_id=getattr(update, "update_id", None),
+            ):
+                return await func(update, context)
+        return wrapper
+    return decorator
+
+
+def _response_attrs(response) -> dict:
+    """HTTP-статус и размер ответа requests для спана"""
+    return {"http.status_code": response.status_code, "bytes": len(response.content or b"")}
+
+
+def _extract_display_urls_from_html(
+    page_url: str,
+    cookiejar: http.cookiejar.CookieJar | None = None,
+    failures: list | None = None,
+    sizes: dict[str, tuple[int, int]] | None = None,
+) -> list[str]:
+    import requests
+
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
         'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
@@ -208,10 +726,14 @@ def _extract_display_urls_from_html(page_url: str, cookiejar: http.cookiejar.Coo
         'Referer': 'https://www.instagram.com/',
         'X-IG-App-ID': os.getenv('INSTAGRAM_APP_ID', '936619743392459'),
     }
-    response = requests.get(page_url, headers=headers, cookies=cookiejar, timeout=30)
-    response.raise_for_status()
+    with _span("extract.html", url=page_url) as span:
+        response = requests.get(page_url, headers=headers, cookies=cookiejar, timeout=30)
+        span.set(**_response_attrs(response))
+        response.raise_for_status()
     if isinstance(response.url, str) and any(x in response.url.lower() for x in ["/accounts/login", "/challenge/"]):
         logger.info("IG html redirected to auth page: %s", response.url)
+        if failures is not None:
+            failures.append(f"html redirected to auth page {response.url}")
     text = response.text or ""
 
     urls = []
@@ -219,6 +741,7 @@ def _extract_display_urls_from_html(page_url: str, cookiejar: http.cookiejar.Coo
     # Prefer best display_resources src (usually full-size, not cropped thumbnail)
     best_src = None
     best_score = -1
+    best_w = best_h = 0
     for m in re.finditer(r'"config_width"\s*:\s*(\d+)\s*,\s*"config_height"\s*:\s*(\d+)\s*,\s*"src"\s*:\s*"([^"]+)"', text):
         try:
             w = int(m.group(1))
@@ -234,9 +757,13 @@ def _extract_display_urls_from_html(page_url: str, cookiejar: http.cookiejar.Coo
         if score > best_score:
             best_score = score
             best_src = src
+            best_w, best_h = w, h
 
+    # Размеры, известные из страницы, точнее маркеров в URL: по ним и выбираем вариант кадра
+    known_sizes = {}
     if best_src:
         urls.append(best_src)
+        known_sizes[best_src] = (best_w, best_h)
 
     for m in re.finditer(r'"display_url"\s*:\s*"([^"]+)"', text):
         u = _unescape_jsonish_url(m.group(1))
@@ -249,23 +776,26 @@ def _extract_display_urls_from_html(page_url: str, cookiejar: http.cookiejar.Coo
         if u.startswith("http") and any(ext in u.lower() for ext in [".jpg", ".jpeg", ".png", ".webp"]):
             urls.append(u)
 
-    # de-dup preserving order
-    seen = set()
-    out = []
-    for u in urls:
-        if u in seen:
-            continue
-        seen.add(u)
-        out.append(u)
+    if sizes is not None:
+        sizes.update(known_sizes)
+
+    # Один URL на кадр, в наибольшем размере
+    out = _resolve_cdn_candidates(urls, known_sizes)
     if not out:
         logger.info("IG html parse: no image candidates found")
+        if failures is not None and '"is_private":true' in text:
+            failures.append("html: account is_private")
     return out
 
 
 def _extract_display_urls_from_json_endpoint(
     page_url: str,
     cookiejar: http.cookiejar.CookieJar | None = None,
+    failures: list | None = None,
+    sizes: dict[str, tuple[int, int]] | None = None,
 ) -> list[str]:
+    import requests
+
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
         'Accept': 'application/json,text/plain,*/*',
@@ -300,9 +830,13 @@ def _extract_display_urls_from_json_endpoint(
             )
         )
         try:
-            r = requests.get(api_url, headers=headers, cookies=cookiejar, timeout=30)
+            with _span("extract.json", url=api_url) as span:
+                r = requests.get(api_url, headers=headers, cookies=cookiejar, timeout=30)
+                span.set(**_response_attrs(r))
             if isinstance(r.url, str) and any(x in r.url.lower() for x in ["/accounts/login", "/challenge/"]):
                 logger.info("IG json redirected to auth page: %s", r.url)
+                if failures is not None:
+                    failures.append(f"json redirected to auth page {r.url}")
             r.raise_for_status()
             break
         except Exception as e:
@@ -311,6 +845,8 @@ def _extract_display_urls_from_json_endpoint(
 
     if r is None:
         logger.info("IG json endpoint failed: %s", str(last_err))
+        if failures is not None and last_err is not None:
+            failures.append(last_err)
         return []
 
     try:
@@ -357,6 +893,8 @@ def _extract_display_urls_from_json_endpoint(
     pool = non_square or candidates
     best = max(pool, key=lambda c: c[0] * c[1])
     logger.info("IG json best image candidate %sx%s %s", best[0], best[1], best[2][:160])
+    if sizes is not None:
+        sizes[best[2]] = (best[0], best[1])
     return [best[2]]
 
 
@@ -371,6 +909,28 @@ def _guess_ext_from_url(url: str) -> str:
     return ".jpg"
 
 
+@functools.lru_cache(maxsize=None)
+def _pil_image():
+    """Модуль PIL.Image или None, если Pillow не установлен"""
+    try:
+        from PIL import Image
+
+        return Image
+    except Exception:
+        return None
+
+
+_INSTAGRAM_USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.3 Safari/605.1.15',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
+]
+
+
+def _instagram_cookies_path() -> Path:
+    return Path(os.getenv("INSTAGRAM_COOKIES_FILE") or "cookies.txt")
+
+
 def _load_cookiejar(cookies_path: Path) -> http.cookiejar.MozillaCookieJar | None:
     try:
         jar = http.cookiejar.MozillaCookieJar()
@@ -380,7 +940,21 @@ def _load_cookiejar(cookies_path: Path) -> http.cookiejar.MozillaCookieJar | Non
         return None
 
 
+def _verify_image(filepath: str) -> bool:
+    Image = _pil_image()
+    if Image is None:
+        return True
+    try:
+        with Image.open(filepath) as im:
+            im.verify()
+        return True
+    except Exception:
+        return False
+
+
 def _download_binary_to_file(url: str, filepath: str, cookiejar: http.cookiejar.CookieJar | None = None) -> str:
+    import requests
+
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
         'Accept-Language': 'en-US,en;q=0.9',
@@ -388,29 +962,60 @@ def _download_binary_to_file(url: str, filepath: str, cookiejar: http.cookiejar.
     }
     Path(os.path.dirname(filepath)).mkdir(parents=True, exist_ok=True)
 
+    # Файл остался от прерванной задачи (бот перезапустился до отправки) — не качаем заново
+    if os.path.exists(filepath) and os.path.getsize(filepath) > 0 and _verify_image(filepath):
+        return filepath
+
+    # Качаем в .part и докачиваем его через Range после обрыва или перезапуска
+    part_path = filepath + ".part"
+
     for _attempt in range(3):
-        response = requests.get(url, headers=headers, cookies=cookiejar, timeout=60)
-        response.raise_for_status()
-        content = response.content or b""
-        if not content:
-            continue
+        resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        request_headers = dict(headers)
+        if resume_from:
+            request_headers['Range'] = f'bytes={resume_from}-'
+
+        with _span("fetch.binary", url=url, resume_from=resume_from) as span:
+            response = requests.get(url, headers=request_headers, cookies=cookiejar, stream=True, timeout=60)
+            span.set(**{"http.status_code": response.status_code})
+            if resume_from and response.status_code == 416:
+                os.remove(part_path)
+                continue
+            response.raise_for_status()
+
+            if response.status_code != 206:
+                # Сервер проигнорировал Range — начинаем с нуля
+                resume_from = 0
 
-        with open(filepath, 'wb') as f:
-            f.write(content)
+            expected = response.headers.get("Content-Length")
+            total = resume_from + int(expected) if expected and expected.isdigit() else None
+            started_at = time.monotonic()
+            written = resume_from
+
+            with open(part_path, 'ab' if resume_from else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    if not chunk:
+                        continue
+                    f.write(chunk)
+                    written += len(chunk)
+                    _report_progress(
+                        written, total, (written - resume_from) / max(time.monotonic() - started_at, 1e-6)
+                    )
+            span.set(bytes=written - resume_from)
+
+        if not written:
+            continue
 
         try:
-            expected = response.headers.get("Content-Length")
-            if expected and expected.isdigit():
-                actual = os.path.getsize(filepath)
-                if actual != int(expected):
-                    continue
+            # Недокачанный .part оставляем: следующая попытка продолжит с места обрыва
+            if total is not None and written != total:
+                continue
 
-            if _PIL_AVAILABLE:
-                try:
-                    with Image.open(filepath) as im:
-                        im.verify()
-                except Exception:
-                    continue
+            os.replace(part_path, filepath)
+
+            if not _verify_image(filepath):
+                os.remove(filepath)
+                continue
 
             return filepath if os.path.exists(filepath) else None
         except Exception:
@@ -422,27 +1027,33 @@ def _download_binary_to_file(url: str, filepath: str, cookiejar: http.cookiejar.
 def _convert_to_jpeg_if_possible(filepath: str) -> str | None:
     if not filepath or not os.path.exists(filepath):
         return None
-    if not _PIL_AVAILABLE:
+    Image = _pil_image()
+    if Image is None:
         return None
     try:
         root, _ = os.path.splitext(filepath)
         out = root + ".jpg"
-        with Image.open(filepath) as im:
-            im = im.convert("RGB")
-            im.save(out, format="JPEG", quality=95, optimize=True)
+        with _span("convert.jpeg", path=os.path.basename(filepath)):
+            with Image.open(filepath) as im:
+                im = im.convert("RGB")
+                im.save(out, format="JPEG", quality=95, optimize=True)
         return out if os.path.exists(out) else None
     except Exception:
         return None
 
 
 def _extract_og_media_urls(page_url: str, cookiejar: http.cookiejar.CookieJar | None = None) -> list[str]:
+    import requests
+
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
         'Accept-Language': 'en-US,en;q=0.9',
         'Referer': 'https://www.instagram.com/',
     }
-    response = requests.get(page_url, headers=headers, cookies=cookiejar, timeout=30)
-    response.raise_for_status()
+    with _span("extract.og", url=page_url) as span:
+        response = requests.get(page_url, headers=headers, cookies=cookiejar, timeout=30)
+        span.set(**_response_attrs(response))
+        response.raise_for_status()
     text = response.text or ""
 
     urls = []
@@ -455,9 +1066,412 @@ def _extract_og_media_urls(page_url: str, cookiejar: http.cookiejar.CookieJar |
     return urls
 
 
-def download_tiktok_ytdlp(url: str) -> str:
-    """Скачивание TikTok видео через yt-dlp"""
+# ========== КАНДИДАТЫ С CDN ==========
+# Экстракторы отдают один и тот же кадр в разных размерах и с разными подписями
+# (oh/oe, x-signature, x-expires). Ключ кадра — id ассета из пути, а не URL без query:
+#
+#   fbcdn / cdninstagram:
+#     https://scontent-fra5-2.cdninstagram.com/v/t51.29350-15/464939212_1096612718576447_3395478069446467185_n.jpg?efg=...&_nc_ht=...&oh=...&oe=...   (оригинал)
+#     https://scontent-fra5-2.cdninstagram.com/v/t51.29350-15/464939212_1096612718576447_3395478069446467185_n.jpg?stp=dst-jpg_e35_p1080x1080_sh0.08&oh=...&oe=...
+#     https://scontent-fra5-1.cdninstagram.com/v/t51.29350-15/464939212_1096612718576447_3395478069446467185_n.jpg?stp=dst-jpg_e35_s640x640_sh0.08&oh=...&oe=...
+#     https://scontent-arn2-1.cdninstagram.com/vp/5e1e7b3fe9e6c5ab5bfe1f2c1e0d5e2c/5D8F8A2B/t51.2885-15/e35/c0.135.1080.1080a/s150x150/66418541_2368853226770412_5208425563936432519_n.jpg
+#     https://instagram.fhel6-1.fna.fbcdn.net/v/t51.2885-15/464939212_1096612718576447_3395478069446467185_n.jpg?stp=c0.180.1440.1440a_dst-jpg_e35_s240x240&...
+#   tiktokcdn (хост и подпись меняются, ассет — "<бакет>/<id>" до "~"):
+#     https://p16-sign-va.tiktokcdn.com/tos-maliva-i-photomode-us/3a8c1e0f9b2d4e6f8a1c3e5b7d9f0a2c~tplv-photomode-image.jpeg?x-expires=...&x-signature=...
+#     https://p77-sign-va.tiktokcdn.com/tos-maliva-i-photomode-us/3a8c1e0f9b2d4e6f8a1c3e5b7d9f0a2c~tplv-photomode-zoomcover:720:720.jpeg?x-expires=...
+#     https://p16-sign-useast2a.tiktokcdn.com/obj/tos-useast5-p-0068-tx/oUAIe7gEBQfDAiFEqAjLgQbQqfHEAAnvIBQSg1~tplv-tiktokx-origin.image?dr=...
+#     https://p16-sign-useast2a.tiktokcdn.com/tos-useast5-p-0068-tx/oUAIe7gEBQfDAiFEqAjLgQbQqfHEAAnvIBQSg1~c5_720x720.jpeg
+
+_FBCDN_SIZE_RE = re.compile(r'(?:^|[/_])[sp](\d{2,5})x(\d{2,5})(?=$|[/_])')
+_FBCDN_CROP_RE = re.compile(r'(?:^|[/_])c\d+(?:\.\d+){3}a(?=$|[/_])')
+_TIKTOK_SIZE_RE = re.compile(r'[:_](\d{2,5})[:x](\d{2,5})(?=$|[.:_])')
+_TIKTOK_CROP_MARKERS = ("cropcenter", "zoomcover", "crop")
+
+
+def _cdn_candidate(url: str) -> tuple[str, int, int, bool, bool] | None:
+    """(id ассета, ширина, высота, обрезан, оригинал) для URL с fbcdn/tiktokcdn, иначе None"""
+    try:
+        parsed = urlparse(url)
+    except Exception:
+        return None
+    host = parsed.netloc.lower()
+    path = parsed.path
+    name = path.rsplit('/', 1)[-1]
+
+    if host.endswith(("fbcdn.net", "cdninstagram.com")):
+        stem = name.rsplit('.', 1)[0]
+        if not stem:
+            return None
+        # Размер и кроп бывают и в пути (старые URL), и в параметре stp (новые)
+        markers = path + "/" + dict(parse_qsl(parsed.query)).get("stp", "")
+        w = h = 0
+        sized = False
+        for m in _FBCDN_SIZE_RE.finditer(markers):
+            w, h = int(m.group(1)), int(m.group(2))
+            sized = True
+        cropped = _FBCDN_CROP_RE.search(markers) is not None
+        # Без маркера размера и кропа CDN отдаёт кадр в исходном разрешении
+        return "fbcdn:" + stem, w, h, cropped, not sized and not cropped
+
+    if "tiktokcdn" in host or "ibyteimg" in host:
+        asset, _, template = name.partition('~')
+        if not asset:
+            return None
+        if not template:
+            asset = asset.rsplit('.', 1)[0]
+        bucket = path.rsplit('/', 2)[-2] if path.count('/') >= 2 else ""
+        w = h = 0
+        m = _TIKTOK_SIZE_RE.search(template)
+        if m:
+            w, h = int(m.group(1)), int(m.group(2))
+        template = template.lower()
+        cropped = any(x in template for x in _TIKTOK_CROP_MARKERS)
+        original = "origin" in template or "photomode-image" in template
+        return f"tiktok:{bucket}/{asset}", w, h, cropped, original
+
+    return None
+
+
+def _resolve_cdn_candidates(urls: list[str], sizes: dict[str, tuple[int, int]] | None = None) -> list[str]:
+    """Оставляет по одному URL на кадр — с наибольшим разрешением, в порядке первого появления.
+
+    sizes — известные экстракторам размеры (config_width, candidates[].width) по URL;
+    они точнее маркеров в самом URL.
+    """
+    sizes = sizes or {}
+    best: dict[str, tuple[tuple, str]] = {}
+    order = []
+    for u in urls:
+        if not isinstance(u, str) or not u.startswith("http"):
+            continue
+        candidate = _cdn_candidate(u)
+        if candidate is None:
+            key, rank = _normalize_url(u), (True, False, 0)
+        else:
+            key, w, h, cropped, original = candidate
+            w, h = sizes.get(u, (w, h))
+            # Необрезанный лучше обрезанного, оригинал — любого уменьшенного, дальше по площади
+            rank = (not cropped, original, w * h)
+        prev = best.get(key)
+        if prev is None:
+            order.append(key)
+            best[key] = (rank, u)
+        elif rank > prev[0]:
+            best[key] = (rank, u)
+    return [best[k][1] for k in order]
+
+
+# ========== СЕГМЕНТИРОВАННОЕ СКАЧИВАНИЕ ==========
+
+# Семафоры соединений на хост: общие для всех одновременных скачиваний
+_host_slots: dict[str, threading.BoundedSemaphore] = {}
+_host_slots_lock = threading.Lock()
+_pwrite_lock = threading.Lock()
+
+# Временный файл сегментированного скачивания. Не ".part": тот yt-dlp считает своим и
+# продолжает, а файл заранее выделен целиком, и после падения бота в нём остаются нули
+# на месте недокачанных сегментов — yt-dlp принял бы его за уже скачанный.
+_SEGMENTED_SUFFIX = ".segpart"
+
+
+def _host_connections(host: str) -> int:
+    """Сколько параллельных соединений допустимо к хосту с учётом лимитов платформы"""
+    host = (host or "").lower()
+    if any(x in host for x in ["instagram", "fbcdn", "cdninstagram"]):
+        # При ограничении скорости Instagram параллельные соединения лишь обходили бы лимит
+        ratelimit = os.getenv("INSTAGRAM_RATELIMIT")
+        if ratelimit and ratelimit.isdigit() and int(ratelimit) > 0:
+            return 1
+        return max(1, DOWNLOAD_CONNECTIONS_INSTAGRAM)
+    if any(x in host for x in ["tiktok", "byteoversea", "ibyteimg", "muscdn"]):
+        return max(1, DOWNLOAD_CONNECTIONS_TIKTOK)
+    return max(1, DOWNLOAD_CONNECTIONS_DEFAULT)
+
+
+def _host_slot(host: str) -> threading.BoundedSemaphore:
+    with _host_slots_lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = threading.BoundedSemaphore(_host_connections(host))
+            _host_slots[host] = slot
+        return slot
+
+
+def _pwrite(fd: int, data: bytes, offset: int):
+    if hasattr(os, "pwrite"):
+        while data:
+            n = os.pwrite(fd, data, offset)
+            data = data[n:]
+            offset += n
+        return
+    # Windows: os.pwrite нет, позиционируемся под общей блокировкой
+    with _pwrite_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+            n = os.write(fd, data)
+            data = data[n:]
+
+
+def _download_segmented(
+    url: str,
+    filepath: str,
+    headers: dict,
+    cookiejar: http.cookiejar.CookieJar | None = None,
+    proxy: str | None = None,
+) -> str | None:
+    """Скачивание параллельными Range-запросами; None — сервер не поддерживает Range или файл мал"""
+    import requests
+
+    proxies = {"http": proxy, "https": proxy} if proxy else None
+    with _span("fetch.head", url=url) as span:
+        probe = requests.head(
+            url, headers=headers, cookies=cookiejar, proxies=proxies, allow_redirects=True, timeout=30
+        )
+        span.set(**{"http.status_code": probe.status_code})
+    length = probe.headers.get("Content-Length")
+    size = int(length) if length and length.isdigit() else 0
+    if probe.status_code >= 400 or probe.headers.get("Accept-Ranges", "").lower() != "bytes":
+        return None
+
+    host = urlparse(probe.url).netloc
+    connections = _host_connections(host)
+    if size < SEGMENTED_MIN_SIZE or connections <= 1:
+        return None
+
+    segment_size = max(256 * 1024, SEGMENTED_SEGMENT_SIZE)
+    segments = [(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+
+    # Заранее выделяем файл целиком: сегменты пишутся каждый по своему смещению
+    Path(os.path.dirname(filepath) or ".").mkdir(parents=True, exist_ok=True)
+    part_path = filepath + _SEGMENTED_SUFFIX
+    with open(part_path, 'wb') as f:
+        f.truncate(size)
+
+    slot = _host_slot(host)
+    reporter = _progress_reporter.get()
+    progress_lock = threading.Lock()
+    started_at = time.monotonic()
+    done = 0
+
+    def _fetch(segment: tuple[int, int]):
+        nonlocal done
+        start, end = segment
+        pos = start
+        last_err = None
+
+        # Каждый сегмент повторяется отдельно и продолжает с последнего записанного байта
+        for attempt in range(SEGMENTED_RETRIES):
+            attempt_from = pos
+            with _span("fetch.segment", range=f"{pos}-{end}", attempt=attempt) as span:
+                try:
+                    with slot:
+                        response = requests.get(
+                            probe.url,
+                            headers={**headers, 'Range': f'bytes={pos}-{end}'},
+                            cookies=cookiejar,
+                            proxies=proxies,
+                            stream=True,
+                            timeout=60,
+                        )
+                        span.set(**{"http.status_code": response.status_code})
+                        if response.status_code != 206:
+                            raise IOError(f"unexpected status {response.status_code} for range {pos}-{end}")
+                        for chunk in response.iter_content(chunk_size=64 * 1024):
+                            if not chunk:
+                                continue
+                            chunk = chunk[:end + 1 - pos]
+                            _pwrite(fd, chunk, pos)
+                            pos += len(chunk)
+                            with progress_lock:
+                                done += len(chunk)
+                                if reporter is not None:
+                                    reporter(done, size, done / max(time.monotonic() - started_at, 1e-6))
+                            if pos > end:
+                                break
+                    if pos > end:
+                        return
+                    last_err = IOError(f"short read for range {start}-{end}")
+                except Exception as e:
+                    last_err = e
+                finally:
+                    span.set(bytes=pos - attempt_from)
+                if last_err is not None:
+                    span.set(error=str(last_err)[:300])
+            time.sleep(min(2 ** attempt, 5))
+
+        raise IOError(f"segment {start}-{end} failed: {last_err}")
+
+    fd = os.open(part_path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+    try:
+        with _span("fetch.segmented", host=host, bytes=size, segments=len(segments), connections=connections):
+            with ThreadPoolExecutor(max_workers=connections, thread_name_prefix="segment") as pool:
+                # Каждому сегменту — своя копия контекста (трассировка текущего запроса)
+                futures = [pool.submit(copy_context().run, _fetch, segment) for segment in segments]
+                for future in futures:
+                    future.result()
+    except BaseException:
+        # Продолжить частично заполненный файл нельзя — не известно, какие сегменты дописаны
+        os.close(fd)
+        fd = None
+        with contextlib.suppress(OSError):
+            os.remove(part_path)
+        raise
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+    os.replace(part_path, filepath)
+    logger.info(
+        "Segmented download %s: %.1f MB in %d segments over %d connections, %.1f s",
+        host, size / (1024 * 1024), len(segments), connections, time.monotonic() - started_at,
+    )
+    return filepath
+
+
+# ========== ПУЛ YoutubeDL ==========
+
+class _PooledYDL:
+    __slots__ = ("ydl", "created_at", "uses")
+
+    def __init__(self, ydl):
+        self.ydl = ydl
+        self.created_at = time.monotonic()
+        self.uses = 0
+
+
+class _YoutubeDLPool:
+    """Готовые экземпляры YoutubeDL по идентичности (платформа, прокси, cookies, User-Agent)"""
+
+    def __init__(self, max_idle: int, max_uses: int, max_age: float):
+        self.max_idle = max(0, max_idle)
+        self.max_uses = max(1, max_uses)
+        self.max_age = max_age
+        self._idle: dict[tuple, list[_PooledYDL]] = {}
+        # id() выданных экземпляров, которые по возврату закрываются, а не идут в пул
+        self._discarded: set[int] = set()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.recycled = 0
+        self.setup_seconds = 0.0
+
+    def _create(self, opts: dict) -> _PooledYDL:
+        import yt_dlp
+
+        started_at = time.monotonic()
+        item = _PooledYDL(yt_dlp.YoutubeDL(opts))
+        with self._lock:
+            self.created += 1
+            self.setup_seconds += time.monotonic() - started_at
+        return item
+
+    def _healthy(self, item: _PooledYDL) -> bool:
+        return item.uses < self.max_uses and time.monotonic() - item.created_at < self.max_age
+
+    def _close(self, item: _PooledYDL):
+        # close() закрывает сетевые сессии, но перед этим вызывает save_cookies() и записал бы
+        # jar из памяти поверх cookies.txt, который могли заменить после создания экземпляра.
+        # Пул cookies обратно не пишет: файл — источник истины, экземпляры только читают его.
+        item.ydl.params['cookiefile'] = None
+        try:
+            item.ydl.close()
+        except Exception as e:
+            logger.debug("YoutubeDL close failed: %s", e)
+
+    def _release(self, key: tuple, item: _PooledYDL):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if self._healthy(item) and len(idle) < self.max_idle:
+                idle.append(item)
+                return
+            self.recycled += 1
+        self._close(item)
+
+    @contextlib.contextmanager
+    def checkout(self, key: tuple, opts: dict):
+        item = None
+        stale = []
+        with self._lock:
+            if key not in self._idle:
+                # Новый ключ (например, после замены cookies.txt): заодно выбрасываем
+                # устаревшие экземпляры под старыми ключами, которые уже никто не спросит
+                for other in self._idle.values():
+                    stale.extend(c for c in other if not self._healthy(c))
+                    other[:] = [c for c in other if self._healthy(c)]
+                self.recycled += len(stale)
+            idle = self._idle.get(key) or []
+            while idle:
+                candidate = idle.pop()
+                if self._healthy(candidate):
+                    item = candidate
+                    break
+                stale.append(candidate)
+                self.recycled += 1
+
+        for old in stale:
+            self._close(old)
+
+        if item is None:
+            item = self._create(opts)
+        else:
+            with self._lock:
+                self.reused += 1
+
+        # Счётчики, которые YoutubeDL копит между скачиваниями (autonumber в outtmpl, код возврата)
+        item.ydl._num_downloads = 0
+        item.ydl._download_retcode = 0
+
+        try:
+            yield item.ydl
+        except BaseException:
+            # После ошибки состояние экземпляра (сессии, счётчики, частичные загрузки) не
+            # гарантировано — в пул его не возвращаем
+            with self._lock:
+                self.recycled += 1
+            self._close(item)
+            raise
+        else:
+            item.uses += 1
+            with self._lock:
+                discard = id(item.ydl) in self._discarded
+            if discard:
+                with self._lock:
+                    self.recycled += 1
+                self._close(item)
+            else:
+                self._release(key, item)
+        finally:
+            with self._lock:
+                self._discarded.discard(id(item.ydl))
+            if (self.created + self.reused) % 50 == 0:
+                logger.info("yt-dlp pool: %s", self.report())
+
+    def discard(self, ydl):
+        """Не возвращать выданный экземпляр в пул (extract_info упал, но ошибку обработали)"""
+        with self._lock:
+            self._discarded.add(id(ydl))
+
+    def prewarm(self, key: tuple, opts: dict):
+        with self._lock:
+            if self._idle.get(key):
+                return
+        self._release(key, self._create(opts))
+
+    def report(self) -> str:
+        with self._lock:
+            avg_setup = self.setup_seconds / self.created if self.created else 0.0
+            return (
+                f"created={self.created} reused={self.reused} recycled={self.recycled} "
+                f"avg_setup={avg_setup * 1000:.0f} ms saved~{self.reused * avg_setup:.1f} s"
+            )
+
+
+_ytdl_pool = _YoutubeDLPool(YTDLP_POOL_SIZE, YTDLP_POOL_MAX_USES, YTDLP_POOL_MAX_AGE_SECONDS)
+
+
+def _tiktok_ydl_opts() -> tuple[tuple, dict]:
     proxy = os.getenv("TIKTOK_PROXY") or os.getenv("HTTPS_PROXY") or os.getenv("HTTP_PROXY")
+    ua = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
     ydl_opts = {
         'format': 'best',
         'outtmpl': f'{DOWNLOAD_FOLDER}/%(title)s.%(ext)s',
@@ -467,46 +1481,23 @@ def download_tiktok_ytdlp(url: str) -> str:
         'merge_output_format': 'mp4',
         'retries': 5,
         'fragment_retries': 5,
+        'concurrent_fragment_downloads': _host_connections("tiktok.com"),
         'socket_timeout': 60,
         'http_headers': {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+            'User-Agent': ua,
         },
+        'progress_hooks': [_ytdlp_progress_hook],
     }
 
     if proxy:
         ydl_opts['proxy'] = proxy
 
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info)
-
-            # Проверяем, скачался ли файл
-            if not os.path.exists(filename):
-                # Пробуем найти файл с другим расширением
-                base_name = os.path.splitext(filename)[0]
-                for ext in ['.mp4', '.webm', '.mkv']:
-                    if os.path.exists(base_name + ext):
-                        return base_name + ext
-
-            return filename if os.path.exists(filename) else None
-
-    except Exception as e:
-        logger.error(f"Error downloading TikTok: {e}")
-        return None
+    return ("tiktok", proxy, None, ua), ydl_opts
 
 
-def download_instagram_ytdlp(url: str) -> str:
-    """Альтернативный способ для Instagram через yt-dlp (видео, фото, карусели)"""
+def _instagram_ydl_opts(ua: str) -> tuple[tuple, dict]:
     proxy = os.getenv("INSTAGRAM_PROXY") or os.getenv("HTTPS_PROXY") or os.getenv("HTTP_PROXY")
-    cookies_path = Path(os.getenv("INSTAGRAM_COOKIES_FILE") or "cookies.txt")
-
-    user_agents = [
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
-        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.3 Safari/605.1.15',
-        'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
-    ]
-    ua = random.choice(user_agents)
+    cookies_path = _instagram_cookies_path()
 
     ratelimit = os.getenv("INSTAGRAM_RATELIMIT")
     ratelimit = int(ratelimit) if ratelimit and ratelimit.isdigit() else 0
@@ -530,9 +1521,10 @@ def download_instagram_ytdlp(url: str) -> str:
         'retries': 5,
         'fragment_retries': 5,
         'extractor_retries': 5,
-        'concurrent_fragment_downloads': 1,
+        'concurrent_fragment_downloads': _host_connections("instagram.com"),
         'sleep_interval': max(0.0, sleep_interval),
         'max_sleep_interval': max(0.0, max_sleep_interval),
+        'progress_hooks': [_ytdlp_progress_hook],
     }
 
     if ratelimit > 0:
@@ -541,21 +1533,125 @@ def download_instagram_ytdlp(url: str) -> str:
     if proxy:
         ydl_opts['proxy'] = proxy
 
+    cookies = None
     if cookies_path.is_file():
         ydl_opts['cookiefile'] = str(cookies_path)
-    else:
+        # Замена cookies.txt меняет ключ: экземпляры со старым jar больше не выдаются
+        stat = cookies_path.stat()
+        cookies = (str(cookies_path), stat.st_mtime_ns, stat.st_size)
+
+    return ("instagram", proxy, cookies, ua), ydl_opts
+
+
+def _prewarm_ytdlp_pool():
+    key, opts = _tiktok_ydl_opts()
+    _ytdl_pool.prewarm(key, opts)
+    for ua in _INSTAGRAM_USER_AGENTS:
+        key, opts = _instagram_ydl_opts(ua)
+        _ytdl_pool.prewarm(key, opts)
+    logger.info("yt-dlp pool prewarmed: %s", _ytdl_pool.report())
+
+
+def _ytdlp_download(ydl, info: dict) -> dict:
+    """Скачивание по info из extract_info(download=False).
+
+    Прогрессивный поток yt-dlp качает одним соединением (concurrent_fragment_downloads
+    действует только на фрагментные форматы), поэтому одиночный http(s)-формат качаем
+    параллельными Range-запросами сами. Склеиваемые и фрагментные форматы, плейлисты и
+    серверы без Range — штатно через yt-dlp.
+    """
+    progressive = (
+        info.get("_type", "video") == "video"
+        and not info.get("requested_formats")
+        and info.get("protocol") in ("http", "https")
+        and isinstance(info.get("url"), str)
+    )
+    if progressive:
+        filename = ydl.prepare_filename(info)
+        if os.path.exists(filename):
+            return info
+        try:
+            path = _download_segmented(
+                info["url"], filename, info.get("http_headers") or {}, ydl.cookiejar, ydl.params.get("proxy")
+            )
+        except Exception as e:
+            logger.info("Segmented download failed, falling back to yt-dlp: %s", e)
+            path = None
+        if path:
+            # Пауза между скачиваниями, как сделал бы yt-dlp (sleep_interval у Instagram)
+            min_sleep = ydl.params.get("sleep_interval") or 0
+            if min_sleep > 0:
+                time.sleep(random.uniform(min_sleep, max(min_sleep, ydl.params.get("max_sleep_interval") or 0)))
+            return info
+    return ydl.process_ie_result(info, download=True)
+
+
+def download_tiktok_ytdlp(url: str) -> str:
+    """Скачивание TikTok видео через yt-dlp"""
+    if _negative_cache_get(url):
+        return None
+
+    key, ydl_opts = _tiktok_ydl_opts()
+
+    try:
+        with _ytdl_pool.checkout(key, ydl_opts) as ydl, _span("ytdlp.download", url=url):
+            info = _ytdlp_download(ydl, ydl.extract_info(url, download=False))
+            filename = ydl.prepare_filename(info)
+
+            # Проверяем, скачался ли файл
+            if not os.path.exists(filename):
+                # Пробуем найти файл с другим расширением
+                base_name = os.path.splitext(filename)[0]
+                for ext in ['.mp4', '.webm', '.mkv']:
+                    if os.path.exists(base_name + ext):
+                        return base_name + ext
+
+            return filename if os.path.exists(filename) else None
+
+    except Exception as e:
+        logger.error(f"Error downloading TikTok: {e}")
+        _remember_failure(url, [e])
+        return None
+
+
+def _instagram_fallback_dir(url: str) -> str:
+    """Каталог для файлов без id поста — свой на каждую ссылку: файлы, оставшиеся после
+    перезапуска, переиспользуются и не должны смешиваться между постами"""
+    return "ig_" + hashlib.sha1(_media_cache_key(url).encode("utf-8")).hexdigest()[:12]
+
+
+def download_instagram_ytdlp(url: str) -> str:
+    """Альтернативный способ для Instagram через yt-dlp (видео, фото, карусели)"""
+    # Приватные/удалённые ссылки из негативного кэша не стоят ни одного запроса к Instagram
+    if _negative_cache_get(url):
+        return None
+
+    from yt_dlp.utils import DownloadError
+
+    cookies_path = _instagram_cookies_path()
+    key, ydl_opts = _instagram_ydl_opts(random.choice(_INSTAGRAM_USER_AGENTS))
+
+    if 'cookiefile' not in ydl_opts:
         logger.info("IG cookies file not found: %s", str(cookies_path))
 
     cookiejar = _load_cookiejar(cookies_path) if cookies_path.is_file() else None
 
+    # Причины неудач по всей цепочке — по ним классифицируем ошибку для негативного кэша
+    failures = []
+
+    fallback_dir = _instagram_fallback_dir(url)
+
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with _ytdl_pool.checkout(key, ydl_opts) as ydl:
             started_at = time.time()
             info = None
             try:
-                info = ydl.extract_info(url, download=False)
-            except Exception:
+                with _span("ytdlp.extract", url=url):
+                    info = ydl.extract_info(url, download=False)
+            except Exception as e:
+                failures.append(e)
                 info = None
+                _ytdl_pool.discard(ydl)
 
             has_video_formats = False
 
@@ -589,8 +1685,11 @@ def download_instagram_ytdlp(url: str) -> str:
 
             if has_video_formats:
                 try:
-                    info = ydl.extract_info(url, download=True)
+                    # info уже извлечён выше — повторно страницу поста не запрашиваем
+                    with _span("ytdlp.download", url=url):
+                        info = _ytdlp_download(ydl, info)
                 except DownloadError as e:
+                    _ytdl_pool.discard(ydl)
                     if "no video formats found" not in str(e).lower():
                         raise
 
@@ -615,15 +1714,19 @@ def download_instagram_ytdlp(url: str) -> str:
 
             if not has_video_formats:
                 extracted_urls = []
+                # url -> (ширина, высота), известные экстракторам: точнее маркеров в самих URL
+                known_sizes = {}
                 try:
-                    extracted_urls = _extract_display_urls_from_json_endpoint(url, cookiejar)
-                except Exception:
+                    extracted_urls = _extract_display_urls_from_json_endpoint(url, cookiejar, failures, known_sizes)
+                except Exception as e:
+                    failures.append(e)
                     extracted_urls = []
 
                 if not extracted_urls:
                     try:
-                        extracted_urls = _extract_display_urls_from_html(url, cookiejar)
-                    except Exception:
+                        extracted_urls = _extract_display_urls_from_html(url, cookiejar, failures, known_sizes)
+                    except Exception as e:
+                        failures.append(e)
                         extracted_urls = []
 
                 if extracted_urls:
@@ -634,18 +1737,9 @@ def download_instagram_ytdlp(url: str) -> str:
                     except Exception:
                         is_carousel = False
 
-                    # Remove duplicates (HTML can contain many URLs for the same image at different sizes)
-                    seen_norm = set()
-                    deduped = []
-                    for u in extracted_urls:
-                        if not isinstance(u, str) or not u.startswith("http"):
-                            continue
-                        nu = _normalize_url(u)
-                        if nu in seen_norm:
-                            continue
-                        seen_norm.add(nu)
-                        deduped.append(u)
-                    extracted_urls = deduped
+                    # Remove duplicates (HTML can contain many URLs for the same image at different sizes):
+                    # one URL per CDN asset, the highest-resolution variant wins
+                    extracted_urls = _resolve_cdn_candidates(extracted_urls, known_sizes)
 
                     # For single-photo posts, download only the best candidate
                     if not is_carousel:
@@ -654,7 +1748,7 @@ def download_instagram_ytdlp(url: str) -> str:
                     base_id = None
                     if isinstance(info, dict):
                         base_id = info.get("id")
-                    base_dir = Path(DOWNLOAD_FOLDER) / (base_id or "ig")
+                    base_dir = Path(DOWNLOAD_FOLDER) / (base_id or fallback_dir)
                     preferred = []
                     for idx, u in enumerate(extracted_urls[:10], start=1):
                         ext = _guess_ext_from_url(u)
@@ -738,26 +1832,22 @@ def download_instagram_ytdlp(url: str) -> str:
                 _collect_image_urls(info)
 
                 # Always try to prepend full-size URLs from page HTML (display_resources/display_url)
+                known_sizes = {}
                 try:
-                    html_urls = _extract_display_urls_from_html(url, cookiejar)
-                except Exception:
+                    html_urls = _extract_display_urls_from_html(url, cookiejar, failures, known_sizes)
+                except Exception as e:
+                    failures.append(e)
                     html_urls = []
 
                 if html_urls:
-                    seen = set()
-                    merged = []
-                    for u in (html_urls + image_urls):
-                        if u in seen:
-                            continue
-                        seen.add(u)
-                        merged.append(u)
-                    image_urls = merged
+                    image_urls = html_urls + image_urls
+                image_urls = _resolve_cdn_candidates(image_urls, known_sizes)
 
                 if image_urls:
                     base_id = None
                     if isinstance(info, dict):
                         base_id = info.get("id")
-                    base_dir = Path(DOWNLOAD_FOLDER) / (base_id or "ig")
+                    base_dir = Path(DOWNLOAD_FOLDER) / (base_id or fallback_dir)
                     for idx, u in enumerate(image_urls[:10], start=1):
                         ext = _guess_ext_from_url(u)
                         out = str(base_dir / f"fallback_{idx}{ext}")
@@ -771,11 +1861,12 @@ def download_instagram_ytdlp(url: str) -> str:
             if not downloaded_files:
                 try:
                     og_urls = _extract_og_media_urls(url, cookiejar)
-                except Exception:
+                except Exception as e:
+                    failures.append(e)
                     og_urls = []
 
                 if og_urls:
-                    base_dir = Path(DOWNLOAD_FOLDER) / "ig"
+                    base_dir = Path(DOWNLOAD_FOLDER) / fallback_dir
                     for idx, u in enumerate(og_urls[:5], start=1):
                         ext = _guess_ext_from_url(u)
                         out = str(base_dir / f"og_{idx}{ext}")
@@ -787,6 +1878,7 @@ def download_instagram_ytdlp(url: str) -> str:
                             continue
 
             if not downloaded_files:
+                _remember_failure(url, failures)
                 return None
 
             # Если один файл – ведём себя как раньше, возвращая строку
@@ -801,19 +1893,19 @@ def download_instagram_ytdlp(url: str) -> str:
         err_str = str(e).lower()
         if 'cookies' in err_str or 'login' in err_str or 'rate-limit' in err_str:
             logger.error("Instagram может требовать авторизацию или куки устарели. Обновите cookies.txt.")
+        _remember_failure(url, failures + [e])
         return None
 
 
 def download_video_direct(url: str) -> str:
     """Прямое скачивание видео"""
+    import requests
+
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
         'Accept-Language': 'en-US,en;q=0.9',
     }
 
-    response = requests.get(url, headers=headers, stream=True, timeout=30)
-    response.raise_for_status()
-
     # Получаем имя файла из URL или генерируем
     parsed_url = urlparse(url)
     filename = parsed_url.path.split('/')[-1] or 'video.mp4'
@@ -822,162 +1914,1472 @@ def download_video_direct(url: str) -> str:
 
     filepath = os.path.join(DOWNLOAD_FOLDER, clean_filename(filename))
 
-    with open(filepath, 'wb') as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            if chunk:
-                f.write(chunk)
+    # Большие файлы с поддержкой Range качаем в несколько соединений
+    try:
+        segmented = _download_segmented(url, filepath, headers)
+        if segmented:
+            return segmented
+    except Exception as e:
+        logger.info("Segmented download failed, falling back to a single stream: %s", e)
+
+    with _span("fetch.direct", url=url) as span:
+        response = requests.get(url, headers=headers, stream=True, timeout=30)
+        span.set(**{"http.status_code": response.status_code})
+        response.raise_for_status()
+
+        expected = response.headers.get("Content-Length")
+        total = int(expected) if expected and expected.isdigit() else None
+        started_at = time.monotonic()
+        written = 0
+
+        with open(filepath, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                if chunk:
+                    f.write(chunk)
+                    written += len(chunk)
+                    _report_progress(written, total, written / max(time.monotonic() - started_at, 1e-6))
+        span.set(bytes=written)
 
     return filepath if os.path.exists(filepath) else None
 
 
-# ========== ОБРАБОТЧИК СООБЩЕНИЙ ==========
+# ========== ПОДГОТОВКА ВИДЕО ==========
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка входящих сообщений с ссылками"""
-    user = update.effective_user
-    message_text = update.message.text
+# Контейнеры, которые можно перепаковать в faststart MP4 без перекодирования
+_FASTSTART_EXTS = {".mp4", ".m4v", ".mov"}
+
+# ffmpeg/ffprobe — отдельные процессы, поток пула лишь ждёт их завершения
+_video_executor = ThreadPoolExecutor(max_workers=max(1, VIDEO_POSTPROCESS_WORKERS), thread_name_prefix="video-post")
 
-    logger.info(f"User {user.id} sent: {message_text}")
 
-    # Проверяем, есть ли ссылка в сообщении (поддерживаем поддомены Instagram/TikTok)
-    url_pattern = r'https?://(?:[\w.-]+\.)?(instagram\.com|tiktok\.com)/[^\s]+'
+@functools.lru_cache(maxsize=None)
+def _video_tools() -> tuple[str, str] | None:
+    """(ffmpeg, ffprobe) или None, если подготовка видео выключена или утилиты не найдены"""
+    if not VIDEO_POSTPROCESS:
+        return None
+    ffmpeg = shutil.which(FFMPEG_PATH or "ffmpeg")
+    ffprobe = shutil.which(FFPROBE_PATH or "ffprobe")
+    if not ffmpeg or not ffprobe:
+        logger.info("ffmpeg/ffprobe not found, video post-processing disabled")
+        return None
+    return ffmpeg, ffprobe
 
-    match = re.search(url_pattern, message_text)
 
-    if not match:
-        await update.message.reply_text(
-            "❌ Пожалуйста, отправьте корректную ссылку на видео Instagram или TikTok."
+def _run_tool(args: list[str]) -> subprocess.CompletedProcess | None:
+    try:
+        with _span("tool." + os.path.basename(args[0]), args=" ".join(args[1:])[:300]) as span:
+            proc = subprocess.run(
+                args,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=VIDEO_POSTPROCESS_TIMEOUT_SECONDS,
+                check=False,
+            )
+            span.set(returncode=proc.returncode)
+    except Exception as e:
+        logger.info("%s failed: %s", os.path.basename(args[0]), e)
+        return None
+    if proc.returncode != 0:
+        logger.info(
+            "%s exited with %s: %s",
+            os.path.basename(args[0]),
+            proc.returncode,
+            proc.stderr.decode("utf-8", "replace").strip()[-300:],
         )
-        return
-
-    url = _normalize_url(match.group(0))
+        return None
+    return proc
+
+
+def _mp4_moov_after_mdat(path: str) -> bool:
+    """True, если атом moov лежит после mdat: клиент не начнёт воспроизведение до конца загрузки"""
+    seen_mdat = False
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        pos = 0
+        while pos + 8 <= file_size:
+            f.seek(pos)
+            size, box = struct.unpack(">I4s", f.read(8))
+            if size == 1:
+                ext = f.read(8)
+                if len(ext) < 8:
+                    break
+                size = struct.unpack(">Q", ext)[0]
+            elif size == 0:
+                size = file_size - pos
+            if size < 8:
+                break
+            if box == b"moov":
+                return seen_mdat
+            if box == b"mdat":
+                seen_mdat = True
+            pos += size
+    return False
+
+
+def _probe_video(ffprobe: str, path: str) -> dict:
+    """Длительность и размеры первой видеодорожки (с учётом поворота)"""
+    proc = _run_tool([
+        ffprobe, "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "stream=width,height,duration:stream_tags=rotate:stream_side_data=rotation:format=duration",
+        "-of", "json",
+        path,
+    ])
+    if proc is None:
+        return {}
+    try:
+        data = json.loads(proc.stdout or b"{}")
+    except Exception:
+        return {}
 
-    # Отправляем сообщение о начале загрузки
-    status_msg = await update.message.reply_text("⏳ Скачиваю видео...")
-    filepath = None
-    filepaths = []
-    is_instagram = False
+    streams = data.get("streams") or [{}]
+    stream = streams[0] if isinstance(streams[0], dict) else {}
+    meta = {}
 
     try:
-        # Определяем платформу и выбираем метод скачивания
-        if 'tiktok.com' in url:
-            await status_msg.edit_text("⏳ Скачиваю TikTok видео...")
-            filepath = await asyncio.to_thread(download_tiktok_ytdlp, url)
+        duration = float(stream.get("duration") or (data.get("format") or {}).get("duration") or 0)
+    except (TypeError, ValueError):
+        duration = 0
+    if duration > 0:
+        meta["duration"] = max(1, round(duration))
+
+    width, height = stream.get("width"), stream.get("height")
+    if isinstance(width, int) and isinstance(height, int) and width > 0 and height > 0:
+        rotation = (stream.get("tags") or {}).get("rotate")
+        for side_data in stream.get("side_data_list") or []:
+            if isinstance(side_data, dict) and "rotation" in side_data:
+                rotation = side_data["rotation"]
+        try:
+            if int(float(rotation or 0)) % 180:
+                width, height = height, width
+        except (TypeError, ValueError):
+            pass
+        meta["width"] = width
+        meta["height"] = height
+
+    return meta
+
+
+def _postprocess_video(path: str) -> tuple[str, dict, list[str]]:
+    """Рабочий поток: (путь для отправки, параметры для send_video, созданные файлы)"""
+    ffmpeg, ffprobe = _video_tools()
+    created = []
+    send_path = path
+    stem, ext = os.path.splitext(path)
+
+    if ext.lower() in _FASTSTART_EXTS and _mp4_moov_after_mdat(path):
+        out = stem + ".faststart.mp4"
+        proc = _run_tool([
+            ffmpeg, "-y", "-v", "error",
+            "-i", path,
+            "-map", "0:v", "-map", "0:a?", "-dn", "-sn",
+            "-c", "copy",
+            "-movflags", "+faststart",
+            out,
+        ])
+        if os.path.exists(out):
+            created.append(out)
+            if proc is not None and os.path.getsize(out) > 0:
+                send_path = out
+
+    meta = _probe_video(ffprobe, send_path)
+
+    # Превью для Telegram: JPEG не больше 320x320 и 200 КБ
+    thumb = os.path.splitext(send_path)[0] + ".thumb.jpg"
+    seek = min(1.0, meta.get("duration", 0) / 10)
+    proc = _run_tool([
+        ffmpeg, "-y", "-v", "error",
+        "-ss", f"{seek:.2f}",
+        "-i", send_path,
+        "-frames:v", "1",
+        "-vf", "scale=320:320:force_original_aspect_ratio=decrease",
+        "-q:v", "5",
+        thumb,
+    ])
+    if os.path.exists(thumb):
+        created.append(thumb)
+        if proc is not None and 0 < os.path.getsize(thumb) <= 200 * 1024:
+            # Байты, а не путь: иначе PTB прочитает файл уже в event loop
+            meta["thumbnail"] = Path(thumb).read_bytes()
+
+    return send_path, meta, created
+
+
+async def _prepare_video(path: str, cleanup_paths: set[str]) -> tuple[str, dict]:
+    """Faststart, метаданные и превью в пуле потоков; без ffmpeg видео уходит как есть"""
+    if _video_tools() is None:
+        return path, {}
+
+    loop = asyncio.get_running_loop()
+    try:
+        send_path, meta, created = await loop.run_in_executor(
+            _video_executor, copy_context().run, _postprocess_video, path
+        )
+    except Exception:
+        logger.exception("Video post-processing failed for %s", path)
+        return path, {}
 
-            if not filepath:
-                await status_msg.edit_text(
-                    "❌ Не удалось скачать TikTok видео. Возможно, ссылка недоступна "
-                    "или истек таймаут. Попробуйте другую ссылку."
-                )
-                return
+    cleanup_paths.update(created)
+    return send_path, meta
 
-            filepaths = [filepath]
 
-        elif 'instagram.com' in url:
-            await status_msg.edit_text("⏳ Скачиваю Instagram медиа...")
-            is_instagram = True
+# ========== КЭШ ОТПРАВЛЕННЫХ МЕДИА ==========
 
-            now = time.time()
-            last_ig = float(context.user_data.get("ig_last_ts", 0) or 0)
-            remaining = INSTAGRAM_COOLDOWN_SECONDS - (now - last_ig)
-            if remaining > 0:
-                await status_msg.edit_text(
-                    f"⏳ Подождите {int(remaining)} сек перед следующим скачиванием из Instagram."
-                )
-                return
+# ключ ссылки -> [(kind, file_id), ...], kind: video / photo / document / animation
+# (kind — то, как файл сохранил Telegram, а не то, как его отправляли)
+_sent_media_cache: OrderedDict[str, list[tuple[str, str]]] = OrderedDict()
 
-            context.user_data["ig_last_ts"] = now
+_MEDIA_CAPTIONS = {
+    "video": "🎬 Скачано через бота",
+    "photo": "📷 Скачано через бота",
+    "document": "📎 Скачано через бота",
+    "animation": "🎬 Скачано через бота",
+}
 
-            async with _instagram_semaphore:
-                filepath = await asyncio.to_thread(download_instagram_ytdlp, url)
 
-            if not filepath:
-                await status_msg.edit_text(
-                    "❌ Не удалось скачать Instagram медиа. Возможно:\n• Медиа приватное\n" \
-                    "• Ссылка неверная\n• Проблемы с доступом"
-                )
-                return
+_FAILURE_MESSAGES = {
+    FAILURE_PRIVATE: "❌ Медиа приватное — бот не может его скачать.",
+    FAILURE_NOT_FOUND: "❌ Публикация не найдена или удалена.",
+    FAILURE_LOGIN_REQUIRED: "❌ Instagram требует авторизацию для этой ссылки. Попробуйте позже.",
+}
 
-            if isinstance(filepath, list):
-                filepaths = [p for p in filepath if p]
-            else:
-                filepaths = [filepath]
 
-        valid_paths = [p for p in filepaths if p and os.path.exists(p)]
+def _media_cache_get(url: str) -> list[tuple[str, str]] | None:
+    key = _media_cache_key(url)
+    entries = _sent_media_cache.get(key)
+    if entries:
+        _sent_media_cache.move_to_end(key)
+    return entries
 
-        if valid_paths:
-            # Проверяем размер файла (Telegram ограничение: 50 МБ) для каждого
-            for p in valid_paths:
-                file_size = os.path.getsize(p) / (1024 * 1024)  # в МБ
 
-                if file_size > 50:
-                    await status_msg.edit_text(
-                        f"❌ Файл слишком большой ({file_size:.1f} МБ). "
-                        f"Telegram ограничивает отправку 50 МБ."
-                    )
-                    return
+def _media_cache_put(url: str, entries: list[tuple[str, str]]):
+    if not entries or SENT_MEDIA_CACHE_SIZE <= 0:
+        return
+    key = _media_cache_key(url)
+    _sent_media_cache[key] = list(entries)
+    _sent_media_cache.move_to_end(key)
+    while len(_sent_media_cache) > SENT_MEDIA_CACHE_SIZE:
+        _sent_media_cache.popitem(last=False)
 
-            await status_msg.edit_text(
-                f"✅ Медиа скачано! ({len(valid_paths)} файл(ов))\n📤 Отправляю..."
-            )
 
-            cleanup_paths = set(valid_paths)
-
-            # Отправляем все медиа (фото/видео)
-            for path in valid_paths:
-                _, ext = os.path.splitext(path)
-                ext = ext.lower()
-
-                send_path = path
-                send_ext = ext
-
-                if is_instagram and (not TELEGRAM_SEND_INSTAGRAM_IMAGES_AS_DOCUMENT) and ext == ".webp":
-                    converted = _convert_to_jpeg_if_possible(path)
-                    if converted:
-                        send_path = converted
-                        send_ext = ".jpg"
-                        cleanup_paths.add(converted)
-
-                with open(send_path, 'rb') as media_file:
-                    if is_instagram and TELEGRAM_SEND_INSTAGRAM_IMAGES_AS_DOCUMENT and send_ext in [".jpg", ".jpeg", ".png", ".webp"]:
-                        await update.message.reply_document(
-                            document=media_file,
-                            filename=os.path.basename(send_path),
-                            caption="📎 Скачано через бота",
-                        )
-                    elif send_ext in [".jpg", ".jpeg", ".png"]:
-                        await update.message.reply_photo(
-                            photo=media_file,
-                            caption="📷 Скачано через бота",
-                        )
-                    elif send_ext in [".webp"]:
-                        await update.message.reply_document(
-                            document=media_file,
-                            filename=os.path.basename(send_path),
-                            caption="📎 Скачано через бота",
-                        )
-                    else:
-                        await update.message.reply_video(
-                            video=media_file,
-                            caption="🎬 Скачано через бота",
-                            supports_streaming=True
-                        )
+def _prepare_media(path: str, is_instagram: bool, cleanup_paths: set[str]) -> tuple[str, str]:
+    """Выбор способа отправки файла: (путь для отправки, kind)"""
+    _, ext = os.path.splitext(path)
+    ext = ext.lower()
 
-            # После отправки очищаем скачанные файлы
-            for path in cleanup_paths:
-                try:
-                    os.remove(path)
-                except Exception:
-                    pass
+    send_path = path
+    send_ext = ext
+
+    if is_instagram and (not TELEGRAM_SEND_INSTAGRAM_IMAGES_AS_DOCUMENT) and ext == ".webp":
+        converted = _convert_to_jpeg_if_possible(path)
+        if converted:
+            send_path = converted
+            send_ext = ".jpg"
+            cleanup_paths.add(converted)
+
+    if is_instagram and TELEGRAM_SEND_INSTAGRAM_IMAGES_AS_DOCUMENT and send_ext in [".jpg", ".jpeg", ".png", ".webp"]:
+        return send_path, "document"
+    if send_ext in [".jpg", ".jpeg", ".png"]:
+        return send_path, "photo"
+    if send_ext in [".webp"]:
+        return send_path, "document"
+    return send_path, "video"
+
+
+def _media_kwargs(kind: str, media, filename: str | None = None, video_meta: dict | None = None) -> dict:
+    kwargs = {kind: media, "caption": _MEDIA_CAPTIONS[kind]}
+    if filename:
+        kwargs["filename"] = filename
+    if kind == "video":
+        kwargs["supports_streaming"] = True
+        if video_meta:
+            kwargs.update(video_meta)
+    return kwargs
+
+
+def _read_media_file(path: str) -> bytes:
+    """Содержимое файла для отправки. PTB всё равно читает файл целиком в память, но
+    делал бы это в event loop; читаем в рабочем потоке и отдаём готовые байты."""
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _file_sizes(paths: list[str]) -> list[int]:
+    return [os.path.getsize(p) for p in paths]
+
+
+def _remove_files(paths):
+    for path in list(paths):
+        try:
+            os.remove(path)
+        except Exception:
+            pass
+
+
+def _sent_media_entry(message, kind: str) -> tuple[str, str | None]:
+    """(kind, file_id) отправленного файла — в том виде, в каком его сохранил Telegram"""
+    if message is None:
+        return kind, None
+    if kind == "photo":
+        return kind, message.photo[-1].file_id if message.photo else None
+    media = getattr(message, kind, None)
+    if media is None and kind == "video":
+        # Telegram может сохранить видео как анимацию или документ: file_id такого файла
+        # годится только для отправки тем же типом
+        if message.animation is not None:
+            kind, media = "animation", message.animation
+        elif message.document is not None:
+            kind, media = "document", message.document
+    return kind, getattr(media, "file_id", None)
+
+
+# ========== ДОПУСК ЗАДАЧ ==========
+
+def _parse_admission_weights(raw: str | None) -> dict[int, float]:
+    """ADMISSION_WEIGHTS="<user_id или chat_id>:<вес>,..." -> {id: вес}"""
+    weights = {}
+    for item in (raw or "").split(","):
+        key, _, value = item.partition(":")
+        try:
+            weights[int(key.strip())] = max(0.01, float(value))
+        except ValueError:
+            continue
+    return weights
+
+
+class _Waiter:
+    __slots__ = (
+        "start", "seq", "flow", "job_class", "future", "on_position", "last_position", "removed",
+    )
+
+    def __init__(self, start: float, seq: int, flow: tuple, job_class: str, on_position):
+        self.start = start
+        self.seq = seq
+        self.flow = flow
+        self.job_class = job_class
+        self.future = asyncio.get_running_loop().create_future()
+        self.on_position = on_position
+        self.last_position = None
+        # Отменённая задача остаётся в куче до выталкивания (ленивое удаление)
+        self.removed = False
+
+
+class _AdmissionQueue:
+    """Взвешенная справедливая очередь скачиваний (start-time fair queueing).
+
+    Поток — пара (chat_id, user_id). Пользователь с длинной очередью не задерживает
+    остальных: каждая его следующая задача получает метку позже на 1/вес. Задача
+    запускается, когда есть свободный глобальный слот и слот её платформы.
+
+    Ожидающие лежат в кучах по платформам с ключом (метка, seq): выдача слота —
+    O(log n). Позиции в очереди пересчитываются сортировкой, только если кто-то их
+    слушает, и не чаще раза в PROGRESS_EDIT_INTERVAL_SECONDS на всю очередь.
+    """
+
+    def __init__(self, max_inflight: int, class_limits: dict[str, int], weights: dict[int, float], job_seconds: float):
+        self.max_inflight = max(1, max_inflight)
+        self.class_limits = {k: max(1, v) for k, v in class_limits.items()}
+        self.weights = weights
+        self.default_job_seconds = max(1.0, job_seconds)
+        self.inflight = 0
+        self.class_inflight: dict[str, int] = {}
+        self.virtual_time = 0.0
+        self.last_finish: dict[tuple, float] = {}
+        # Платформа -> куча (метка, seq, задача); queued — живые задачи во всех кучах
+        self._heaps: dict[str, list[tuple[float, int, _Waiter]]] = {}
+        self._removed: dict[str, int] = {}
+        self.queued = 0
+        # Сколько ожидающих задач ждут сообщений о своей позиции
+        self._listeners = 0
+        self._notify_handle: asyncio.TimerHandle | None = None
+        self._notified_at = 0.0
+        # Скользящая оценка длительности задачи по платформам
+        self.job_seconds: dict[str, float] = {}
+        self._seq = itertools.count()
+        self._notify_tasks: set[asyncio.Task] = set()
+
+    def _weight(self, flow: tuple) -> float:
+        chat_id, user_id = flow
+        return self.weights.get(user_id) or self.weights.get(chat_id) or 1.0
+
+    def _class_limit(self, job_class: str) -> int:
+        return min(self.max_inflight, self.class_limits.get(job_class, self.max_inflight))
+
+    def _has_capacity(self, job_class: str) -> bool:
+        return (
+            self.inflight < self.max_inflight
+            and self.class_inflight.get(job_class, 0) < self._class_limit(job_class)
+        )
+
+    def _eta(self, ahead: int, ahead_in_class: int, job_class: str) -> float:
+        """Оценка ожидания: сколько «раундов» слотов пройдёт до задачи"""
+        seconds = self.job_seconds.get(job_class, self.default_job_seconds)
+        rounds = max(ahead // self.max_inflight, ahead_in_class // self._class_limit(job_class)) + 1
+        return rounds * seconds
+
+    def estimate_wait(self, flow: tuple, job_classes: list[str], per_flow_limit: int) -> float:
+        """Ожидание последней из задач нового сообщения, если поставить их в очередь сейчас"""
+        if not job_classes:
+            return 0.0
+        start = max(self.virtual_time, self.last_finish.get(flow, 0.0))
+        # Один проход по очереди: сколько задач каждой платформы стоит не позже метки
+        ahead_by_class = {
+            c: sum(1 for s, _, w in heap if s <= start and not w.removed) for c, heap in self._heaps.items()
+        }
+        ahead = sum(ahead_by_class.values())
+        worst = 0.0
+        for job_class in set(job_classes):
+            ahead_in_class = ahead_by_class.get(job_class, 0)
+            if ahead == 0 and self._has_capacity(job_class):
+                wait = 0.0
+            else:
+                wait = self._eta(ahead, ahead_in_class, job_class)
+            worst = max(worst, wait)
+        # Ссылки одного сообщения идут не больше per_flow_limit за раз
+        own_rounds = (len(job_classes) - 1) // max(1, per_flow_limit)
+        seconds = max(self.job_seconds.get(c, self.default_job_seconds) for c in job_classes)
+        return worst + own_rounds * seconds
+
+    @contextlib.asynccontextmanager
+    async def slot(self, flow: tuple, job_class: str, on_position=None):
+        """Ожидание своей очереди; on_position(позиция, eta) сообщает о продвижении"""
+        start = max(self.virtual_time, self.last_finish.get(flow, 0.0))
+        self.last_finish[flow] = start + 1.0 / self._weight(flow)
+        waiter = _Waiter(start, next(self._seq), flow, job_class, on_position)
+        heapq.heappush(self._heaps.setdefault(job_class, []), (waiter.start, waiter.seq, waiter))
+        self.queued += 1
+        if on_position is not None:
+            self._listeners += 1
+        self._dispatch()
+
+        try:
+            with _span("admission.wait", job_class=job_class, queued=self.queued):
+                await waiter.future
+        except BaseException:
+            if not waiter.future.done() or waiter.future.cancelled():
+                self._remove(waiter)
+                self._schedule_notify()
+            else:
+                # Слот уже выдан, но задача отменена до начала работы
+                self._release(job_class, None)
+            raise
+
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(job_class, time.monotonic() - started_at)
+
+    def _release(self, job_class: str, elapsed: float | None):
+        self.inflight -= 1
+        self.class_inflight[job_class] -= 1
+        if elapsed is not None:
+            prev = self.job_seconds.get(job_class, self.default_job_seconds)
+            self.job_seconds[job_class] = prev * 0.8 + elapsed * 0.2
+        self._dispatch()
+
+    def _forget(self, waiter: _Waiter):
+        waiter.removed = True
+        self.queued -= 1
+        if waiter.on_position is not None:
+            self._listeners -= 1
+
+    def _remove(self, waiter: _Waiter):
+        """Отмена ожидания: задача помечается и выталкивается из кучи позже"""
+        if waiter.removed:
+            return
+        self._forget(waiter)
+        removed = self._removed.get(waiter.job_class, 0) + 1
+        heap = self._heaps[waiter.job_class]
+        # Когда отменённых больше половины кучи, пересобираем её без них
+        if removed * 2 > len(heap):
+            heap[:] = [item for item in heap if not item[2].removed]
+            heapq.heapify(heap)
+            removed = 0
+        self._removed[waiter.job_class] = removed
+
+    def _head(self, job_class: str) -> _Waiter | None:
+        heap = self._heaps.get(job_class)
+        while heap and heap[0][2].removed:
+            heapq.heappop(heap)
+            self._removed[job_class] -= 1
+        return heap[0][2] if heap else None
+
+    def _dispatch(self):
+        while self.queued and self.inflight < self.max_inflight:
+            # Первая по метке задача среди платформ со свободным слотом (платформ единицы)
+            waiter = None
+            for job_class in self._heaps:
+                if not self._has_capacity(job_class):
+                    continue
+                head = self._head(job_class)
+                if head is not None and (waiter is None or (head.start, head.seq) < (waiter.start, waiter.seq)):
+                    waiter = head
+            if waiter is None:
+                break
+            heapq.heappop(self._heaps[waiter.job_class])
+            self._forget(waiter)
+            if waiter.future.cancelled():
+                # Задачу отменили, а обработчик отмены ещё не успел выполниться
+                continue
+            self.inflight += 1
+            self.class_inflight[waiter.job_class] = self.class_inflight.get(waiter.job_class, 0) + 1
+            self.virtual_time = max(self.virtual_time, waiter.start)
+            waiter.future.set_result(None)
+
+        # Метки потоков, отставшие от виртуального времени, ничего не дают
+        if len(self.last_finish) > 1000:
+            self.last_finish = {f: t for f, t in self.last_finish.items() if t > self.virtual_time}
+
+        self._schedule_notify()
+
+    def _schedule_notify(self):
+        """Пересчёт позиций не чаще интервала прогресса и только при наличии слушателей"""
+        if not self._listeners or self._notify_handle is not None:
+            return
+        loop = asyncio.get_running_loop()
+        delay = max(0.0, self._notified_at + PROGRESS_EDIT_INTERVAL_SECONDS - time.monotonic())
+        self._notify_handle = loop.call_later(delay, self._notify_positions)
+
+    def _notify_positions(self):
+        self._notify_handle = None
+        if not self._listeners:
+            return
+        self._notified_at = time.monotonic()
+        waiting = sorted(item for heap in self._heaps.values() for item in heap if not item[2].removed)
+        ahead_in_class: dict[str, int] = {}
+        for position, (_, _, waiter) in enumerate(waiting, start=1):
+            in_class = ahead_in_class.get(waiter.job_class, 0)
+            ahead_in_class[waiter.job_class] = in_class + 1
+            if waiter.on_position is None or position == waiter.last_position:
+                continue
+            waiter.last_position = position
+            eta = self._eta(position - 1, in_class, waiter.job_class)
+            task = asyncio.ensure_future(waiter.on_position(position, eta))
+            self._notify_tasks.add(task)
+            task.add_done_callback(self._notify_tasks.discard)
+
+
+def _job_class(url: str) -> str:
+    return "instagram" if 'instagram.com' in url else "tiktok"
+
+
+_admission = _AdmissionQueue(
+    max_inflight=MAX_INFLIGHT_DOWNLOADS,
+    class_limits={"instagram": INSTAGRAM_MAX_CONCURRENT},
+    weights=_parse_admission_weights(os.getenv("ADMISSION_WEIGHTS")),
+    job_seconds=ADMISSION_JOB_SECONDS,
+)
+
+
+# ========== ОБРАБОТЧИК СООБЩЕНИЙ ==========
+
+# Поддерживаем поддомены Instagram/TikTok
+URL_PATTERN = re.compile(r'https?://(?:[\w.-]+\.)?(instagram\.com|tiktok\.com)/[^\s]+')
+
+
+def _extract_urls(text: str) -> list[str]:
+    """Все ссылки Instagram/TikTok из сообщения (без дубликатов, в порядке появления)"""
+    urls = []
+    seen = set()
+    for m in URL_PATTERN.finditer(text or ""):
+        url = _normalize_url(m.group(0))
+        key = _media_cache_key(url)
+        if key in seen:
+            continue
+        seen.add(key)
+        urls.append(url)
+    return urls[:max(1, MAX_LINKS_PER_MESSAGE)]
+
+
+def _user_semaphore(user_id: int) -> asyncio.Semaphore:
+    """Семафор пользователя; каждый вызов парный с _user_semaphore_release"""
+    sem = _user_semaphores.get(user_id)
+    if sem is None:
+        sem = asyncio.Semaphore(max(1, USER_MAX_CONCURRENT))
+        _user_semaphores[user_id] = sem
+    _user_semaphore_refs[user_id] = _user_semaphore_refs.get(user_id, 0) + 1
+    return sem
+
+
+def _user_semaphore_release(user_id: int):
+    refs = _user_semaphore_refs.get(user_id, 0) - 1
+    if refs > 0:
+        _user_semaphore_refs[user_id] = refs
+        return
+    # Пакетов пользователя больше нет — семафор свободен, следующий создастся заново
+    _user_semaphore_refs.pop(user_id, None)
+    _user_semaphores.pop(user_id, None)
+
+
+class _BatchProgress:
+    """Общее статус-сообщение для всех ссылок из одного сообщения"""
+
+    def __init__(self, status_msg, urls: list[str]):
+        self.status_msg = status_msg
+        self.urls = list(urls)
+        self.states = {u: "⏳ В очереди..." for u in self.urls}
+        self.failed: set[str] = set()
+        self.done: set[str] = set()
+        self._lock = asyncio.Lock()
+        self._last_text = None
+
+    def render(self) -> str:
+        if len(self.urls) == 1:
+            return self.states[self.urls[0]]
+
+        finished = len(self.done) + len(self.failed)
+        if finished >= len(self.urls):
+            header = f"📋 Готово: ✅ {len(self.done)}, ❌ {len(self.failed)}"
+        else:
+            header = f"⏳ Обработано ссылок: {finished}/{len(self.urls)}"
+
+        lines = [header]
+        for idx, u in enumerate(self.urls, start=1):
+            # В сводке показываем только первую строку статуса каждой ссылки
+            state = (self.states[u].splitlines() or [""])[0]
+            lines.append(f"{idx}. {state}")
+        return "\n".join(lines)
+
+    async def set(self, url: str, text: str, ok: bool | None = None):
+        # Запоздавший прогресс из рабочего потока не должен затирать итоговый статус
+        if ok is None and (url in self.done or url in self.failed):
+            return
+
+        self.states[url] = text
+        if ok is True:
+            self.done.add(url)
+        elif ok is False:
+            self.failed.add(url)
+
+        # Одиночную успешную ссылку не перерисовываем: статус всё равно будет удалён
+        if ok is True and len(self.urls) == 1:
+            return
+
+        async with self._lock:
+            rendered = self.render()
+            if rendered == self._last_text:
+                return
+            self._last_text = rendered
+            try:
+                await self.status_msg.edit_text(rendered)
+            except Exception as e:
+                logger.info("Status edit failed: %s", e)
+
+
+# chat_id -> время последнего редактирования статуса прогрессом. Записи старше интервала
+# ничем не отличаются от отсутствующих и вычищаются, когда словарь дорастает до порога.
+_CHAT_STATE_SWEEP_SIZE = 1024
+_chat_progress_edits: dict[int, float] = {}
+_chat_progress_sweep_at = _CHAT_STATE_SWEEP_SIZE
+_chat_progress_lock = threading.Lock()
+
+
+def _sweep_chat_progress_edits(now: float):
+    """Удаление устаревших записей; вызывается под _chat_progress_lock"""
+    global _chat_progress_sweep_at
+    if len(_chat_progress_edits) < _chat_progress_sweep_at:
+        return
+    for chat_id, edited in list(_chat_progress_edits.items()):
+        if now - edited >= PROGRESS_EDIT_INTERVAL_SECONDS:
+            del _chat_progress_edits[chat_id]
+    # Порог растёт вместе с числом живых записей, чтобы чистка оставалась амортизированно O(1)
+    _chat_progress_sweep_at = max(_CHAT_STATE_SWEEP_SIZE, 2 * len(_chat_progress_edits))
+
+
+class _ProgressReporter:
+    """Прогресс из рабочего потока в статус-сообщение, не чаще раза в N секунд на чат"""
+
+    def __init__(self, progress: _BatchProgress, url: str, chat_id: int, prefix: str):
+        self.loop = asyncio.get_running_loop()
+        self.progress = progress
+        self.url = url
+        self.chat_id = chat_id
+        self.prefix = prefix
+
+        # Первое обновление — не раньше чем через интервал: короткие загрузки не дёргают API
+        with _chat_progress_lock:
+            now = time.monotonic()
+            _sweep_chat_progress_edits(now)
+            _chat_progress_edits[chat_id] = max(_chat_progress_edits.get(chat_id, 0.0), now)
+
+    def __call__(self, downloaded: int, total: int | None, speed: float | None):
+        now = time.monotonic()
+        with _chat_progress_lock:
+            if now - _chat_progress_edits.get(self.chat_id, 0.0) < PROGRESS_EDIT_INTERVAL_SECONDS:
+                return
+            _chat_progress_edits[self.chat_id] = now
+
+        text = f"{self.prefix} {_format_progress(downloaded, total, speed)}"
+        asyncio.run_coroutine_threadsafe(self.progress.set(self.url, text), self.loop)
+
+
+async def _send_media(message, path: str, is_instagram: bool, cleanup_paths: set[str]) -> tuple[str, str | None]:
+    """Отправка файла ответом на сообщение; возвращает (kind, file_id)"""
+    # Конвертация через PIL блокирует — выполняем её в рабочем потоке
+    send_path, kind = await asyncio.to_thread(_prepare_media, path, is_instagram, cleanup_paths)
+    video_meta = None
+    if kind == "video":
+        send_path, video_meta = await _prepare_video(send_path, cleanup_paths)
+
+    data = await asyncio.to_thread(_read_media_file, send_path)
+    with _span("upload", kind=kind, bytes=len(data)):
+        reply = getattr(message, f"reply_{kind}")
+        sent = await reply(**_media_kwargs(kind, data, os.path.basename(send_path), video_meta))
+
+    return _sent_media_entry(sent, kind)
+
+
+async def _send_cached_media(message, entries: list[tuple[str, str]], job_id: int | None = None):
+    for kind, file_id in entries:
+        reply = getattr(message, f"reply_{kind}")
+        with _span("upload.cached", kind=kind):
+            await reply(**_media_kwargs(kind, file_id))
+        _journal.add_sent(job_id)
+
+
+def _download_existing(url: str, is_instagram: bool) -> list[str]:
+    if is_instagram:
+        filepath = download_instagram_ytdlp(url)
+    else:
+        filepath = download_tiktok_ytdlp(url)
+
+    if isinstance(filepath, list):
+        filepaths = [p for p in filepath if p]
+    else:
+        filepaths = [filepath] if filepath else []
+    return [p for p in filepaths if os.path.exists(p)]
+
+
+async def _download_media(url: str) -> tuple[list[str], bool]:
+    """Скачивание в рабочем потоке: (существующие файлы, is_instagram)"""
+    is_instagram = 'instagram.com' in url
+
+    with _span("download", url=url, platform=_job_class(url)) as span:
+        # Проверка файлов на диске — в том же рабочем потоке, что и скачивание
+        filepaths = await asyncio.to_thread(_download_existing, url, is_instagram)
+        span.set(files=len(filepaths))
+
+    return filepaths, is_instagram
 
-            await status_msg.delete()
 
+async def _process_link(
+    message: Message,
+    url: str,
+    progress: _BatchProgress,
+    job_id: int | None = None,
+    flow: tuple | None = None,
+) -> bool:
+    """Скачивание и отправка одной ссылки; статус пишется в общее сообщение"""
+    cleanup_paths = set()
+
+    try:
+        failure = _negative_cache_get(url)
+        if failure:
+            await progress.set(url, _FAILURE_MESSAGES[failure], ok=False)
+            return False
+
+        cached = _media_cache_get(url)
+        if cached:
+            await progress.set(url, "📤 Отправляю...")
+            _journal.set_stage(job_id, JOB_SENDING)
+            await _send_cached_media(message, cached, job_id)
+            await progress.set(url, f"✅ Отправлено ({len(cached)} файл(ов))", ok=True)
+            return True
+
+        # Определяем платформу и выбираем метод скачивания
+        if 'tiktok.com' in url:
+            prefix = "⏳ Скачиваю TikTok видео..."
         else:
-            await status_msg.edit_text("❌ Не удалось скачать медиа. Попробуйте другую ссылку.")
+            prefix = "⏳ Скачиваю Instagram медиа..."
+
+        started = False
+
+        async def _on_position(position: int, eta: float):
+            if not started:
+                await progress.set(url, f"🕒 В очереди: {position}-й, ожидание ~{int(eta)} сек")
+
+        # Скачивание начинается, только когда очередь допуска выдаст слот
+        async with _admission.slot(flow or (message.chat_id, message.chat_id), _job_class(url), _on_position):
+            started = True
+            await progress.set(url, prefix)
+            _journal.set_stage(job_id, JOB_DOWNLOADING)
+
+            reporter = _ProgressReporter(progress, url, message.chat_id, prefix)
+            token = _progress_reporter.set(reporter)
+            try:
+                valid_paths, is_instagram = await _download_media(url)
+            finally:
+                _progress_reporter.reset(token)
+        cleanup_paths.update(valid_paths)
+
+        if not valid_paths:
+            failure = _negative_cache_get(url)
+            if failure:
+                await progress.set(url, _FAILURE_MESSAGES[failure], ok=False)
+            elif is_instagram:
+                await progress.set(
+                    url,
+                    "❌ Не удалось скачать Instagram медиа. Возможно:\n• Медиа приватное\n"
+                    "• Ссылка неверная\n• Проблемы с доступом",
+                    ok=False,
+                )
+            else:
+                await progress.set(
+                    url,
+                    "❌ Не удалось скачать TikTok видео. Возможно, ссылка недоступна "
+                    "или истек таймаут. Попробуйте другую ссылку.",
+                    ok=False,
+                )
+            return False
+
+        # Проверяем размер файла (Telegram ограничение: 50 МБ) для каждого
+        for size in await asyncio.to_thread(_file_sizes, valid_paths):
+            file_size = size / (1024 * 1024)  # в МБ
+
+            if file_size > 50:
+                await progress.set(
+                    url,
+                    f"❌ Файл слишком большой ({file_size:.1f} МБ). "
+                    f"Telegram ограничивает отправку 50 МБ.",
+                    ok=False,
+                )
+                return False
+
+        await progress.set(url, f"✅ Медиа скачано! ({len(valid_paths)} файл(ов))\n📤 Отправляю...")
+        _journal.set_stage(job_id, JOB_SENDING)
+
+        # Отправляем все медиа (фото/видео) и запоминаем file_id для повторных запросов
+        entries = []
+        for path in valid_paths:
+            kind, file_id = await _send_media(message, path, is_instagram, cleanup_paths)
+            _journal.add_sent(job_id)
+            if file_id:
+                entries.append((kind, file_id))
+
+        if len(entries) == len(valid_paths):
+            _media_cache_put(url, entries)
+
+        await progress.set(url, f"✅ Отправлено ({len(valid_paths)} файл(ов))", ok=True)
+        return True
 
     except Exception as e:
-        logger.exception("Error in handle_message")
-        await status_msg.edit_text(f"❌ Произошла ошибка: {str(e)}")
+        logger.exception("Error processing %s", url)
+        await progress.set(url, f"❌ Произошла ошибка: {str(e)}", ok=False)
+        return False
+
+    finally:
+        # Очищаем скачанные файлы (и после отправки, и после ошибки)
+        await asyncio.to_thread(_remove_files, cleanup_paths)
+
+
+def _instagram_start_times(urls: list[str], first_start: float) -> dict[str, float]:
+    """Время старта каждой ссылки Instagram: подряд не чаще раза в INSTAGRAM_COOLDOWN_SECONDS"""
+    return {u: first_start + idx * INSTAGRAM_COOLDOWN_SECONDS for idx, u in enumerate(urls)}
+
+
+async def _run_batch(
+    message: Message,
+    user_id: int,
+    progress: _BatchProgress,
+    jobs: dict[str, int | None],
+    start_at: dict[str, float] | None = None,
+):
+    """Параллельная обработка ссылок одного сообщения под лимитом пользователя"""
+    user_sem = _user_semaphore(user_id)
+    flow = (message.chat_id, user_id)
+    start_at = start_at or {}
+
+    async def _run(url: str) -> bool:
+        job_id = jobs.get(url)
+        # Ссылки Instagram ждут своей очереди по кулдауну, не занимая слот пользователя
+        delay = start_at.get(url, 0.0) - time.time()
+        if delay > 0:
+            await progress.set(url, f"⏳ Instagram: начну через {int(math.ceil(delay))} сек (пауза между скачиваниями)")
+            await asyncio.sleep(delay)
+        async with user_sem:
+            with _span("link", url=url, job_id=job_id) as span:
+                ok = await _process_link(message, url, progress, job_id, flow)
+                span.set(ok=ok)
+        _journal.set_stage(job_id, JOB_DONE if ok else JOB_FAILED)
+        return ok
+
+    try:
+        results = await asyncio.gather(*(_run(u) for u in jobs))
+    finally:
+        _user_semaphore_release(user_id)
+
+    if results and all(results) and len(jobs) == len(progress.urls):
+        try:
+            await progress.status_msg.delete()
+        except Exception as e:
+            logger.info("Status delete failed: %s", e)
+
+
+@_traced("message")
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка входящих сообщений с ссылками"""
+    user = update.effective_user
+    message_text = update.message.text
+
+    logger.info(f"User {user.id} sent: {message_text}")
+
+    urls = _extract_urls(message_text)
+
+    if not urls:
+        await update.message.reply_text(
+            "❌ Пожалуйста, отправьте корректную ссылку на видео Instagram или TikTok."
+        )
+        return
+
+    # Сброс нагрузки: если очередь слишком длинная, отказываем сразу, не создавая задач.
+    # Ссылки из кэшей скачивания не требуют и в оценку не входят.
+    if ADMISSION_MAX_WAIT_SECONDS > 0:
+        job_classes = [_job_class(u) for u in urls if not _media_cache_get(u) and not _negative_cache_get(u)]
+        wait = _admission.estimate_wait((update.message.chat_id, user.id), job_classes, USER_MAX_CONCURRENT)
+        if wait > ADMISSION_MAX_WAIT_SECONDS:
+            retry_in = max(5, int(math.ceil((wait - ADMISSION_MAX_WAIT_SECONDS) / 5)) * 5)
+            logger.info("Shedding message from user %s: estimated wait %.0f s", user.id, wait)
+            await update.message.reply_text(
+                f"⏳ Бот сейчас перегружен. Попробуйте снова через {retry_in} сек."
+            )
+            return
+
+    # Отправляем сообщение о начале загрузки
+    if len(urls) == 1:
+        status_msg = await update.message.reply_text("⏳ Скачиваю видео...")
+    else:
+        status_msg = await update.message.reply_text(f"⏳ Скачиваю {len(urls)} ссылок...")
+
+    progress = _BatchProgress(status_msg, urls)
+    active_urls = list(urls)
+
+    # Кулдаун Instagram: новое сообщение ждёт окончания предыдущего, а ссылки внутри
+    # сообщения стартуют с паузой INSTAGRAM_COOLDOWN_SECONDS между собой.
+    # Ссылки из кэшей Instagram не трогают, поэтому кулдаун на них не распространяется.
+    start_at = {}
+    ig_urls = [
+        u for u in urls
+        if 'instagram.com' in u and not _media_cache_get(u) and not _negative_cache_get(u)
+    ]
+    if ig_urls:
+        now = time.time()
+        last_ig = float(context.user_data.get("ig_last_ts", 0) or 0)
+        remaining = INSTAGRAM_COOLDOWN_SECONDS - (now - last_ig)
+        if remaining > 0:
+            for u in ig_urls:
+                await progress.set(
+                    u,
+                    f"⏳ Подождите {int(remaining)} сек перед следующим скачиванием из Instagram.",
+                    ok=False,
+                )
+            active_urls = [u for u in urls if u not in ig_urls]
+        else:
+            start_at = _instagram_start_times(ig_urls, now)
+            context.user_data["ig_last_ts"] = max(start_at.values())
+
+    # Записываем принятые ссылки в журнал до начала скачивания
+    message = update.message
+    jobs = {
+        u: await _journal.add(message.chat_id, message.chat.type, message.message_id, user.id, u)
+        for u in active_urls
+    }
+
+    await _run_batch(message, user.id, progress, jobs, start_at)
+
+
+# ========== ЖУРНАЛ ЗАДАЧ ==========
+
+JOB_QUEUED = "queued"
+JOB_DOWNLOADING = "downloading"
+JOB_SENDING = "sending"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+_JOB_FINISHED = (JOB_DONE, JOB_FAILED)
+
+
+class _JobJournal:
+    """Журнал принятых ссылок в SQLite: незавершённые задачи переживают перезапуск бота"""
+
+    def __init__(self, path: str | None):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        # Все запросы к SQLite идут через один фоновый поток: запись не блокирует event loop,
+        # а очередь сохраняет порядок (чтения видят всё, что было поставлено до них)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-journal")
+
+    def _db(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    chat_type TEXT,
+                    message_id INTEGER NOT NULL,
+                    user_id INTEGER,
+                    url TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    sent INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_stage ON jobs (stage)")
+            # Журналы, созданные до появления счётчика отправленных файлов
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "sent" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN sent INTEGER NOT NULL DEFAULT 0")
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        # Журнал не должен ломать обработку сообщений: ошибки только логируем
+        if not self.path:
+            return []
+        try:
+            with self._lock:
+                cur = self._db().execute(sql, params)
+                return cur.fetchall() if sql.lstrip().upper().startswith("SELECT") else [cur.lastrowid]
+        except sqlite3.Error as e:
+            logger.error("Job journal error: %s", e)
+            return []
+
+    def _submit(self, sql: str, params: tuple = ()):
+        return self._executor.submit(self._execute, sql, params)
+
+    async def _query(self, sql: str, params: tuple = ()) -> list:
+        return await asyncio.wrap_future(self._submit(sql, params))
+
+    async def add(self, chat_id: int, chat_type: str | None, message_id: int, user_id: int | None, url: str) -> int | None:
+        now = time.time()
+        rows = await self._query(
+            "INSERT INTO jobs (chat_id, chat_type, message_id, user_id, url, stage, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (chat_id, chat_type, message_id, user_id, url, JOB_QUEUED, now, now),
+        )
+        return rows[0] if rows else None
+
+    def set_stage(self, job_id: int | None, stage: str):
+        if job_id is None:
+            return
+        self._submit("UPDATE jobs SET stage = ?, updated_at = ? WHERE id = ?", (stage, time.time(), job_id))
+
+    def add_sent(self, job_id: int | None):
+        """+1 файл, уже доставленный пользователю по задаче"""
+        if job_id is None:
+            return
+        self._submit("UPDATE jobs SET sent = sent + 1, updated_at = ? WHERE id = ?", (time.time(), job_id))
+
+    async def failed_urls(self) -> list[str]:
+        rows = await self._query("SELECT DISTINCT url FROM jobs WHERE stage = ?", (JOB_FAILED,))
+        return [r["url"] for r in rows]
+
+    async def unfinished(self) -> list[dict]:
+        rows = await self._query(
+            "SELECT * FROM jobs WHERE stage NOT IN (?, ?) ORDER BY id",
+            _JOB_FINISHED,
+        )
+        return [dict(r) for r in rows]
+
+    def mark_replayed(self, job_id: int):
+        self._submit(
+            "UPDATE jobs SET attempts = attempts + 1, updated_at = ? WHERE id = ?",
+            (time.time(), job_id),
+        )
+
+    def prune(self, max_age_seconds: float):
+        self._submit(
+            "DELETE FROM jobs WHERE stage IN (?, ?) AND updated_at < ?",
+            (*_JOB_FINISHED, time.time() - max_age_seconds),
+        )
+
+
+_journal = _JobJournal(JOB_JOURNAL_PATH)
+
+
+def _journal_message(bot, job: dict) -> Message:
+    """Сообщение-заглушка для ответов по задаче из журнала (исходного Update уже нет)"""
+    message = Message(
+        message_id=job["message_id"],
+        date=dt.datetime.now(dt.timezone.utc),
+        chat=Chat(id=job["chat_id"], type=job["chat_type"] or Chat.PRIVATE),
+    )
+    message.set_bot(bot)
+    return message
+
+
+_INSTAGRAM_SHORTCODE = re.compile(r'instagram\.com/(?:[^/?#]+/)?(?:p|reels?|tv)/([A-Za-z0-9_-]+)')
+
+
+def _job_leftover_paths(url: str) -> set[Path]:
+    """Каталоги, куда скачивание по ссылке складывает файлы (yt-dlp — по id поста)"""
+    paths = set()
+    if 'instagram.com' in url:
+        paths.add(Path(DOWNLOAD_FOLDER) / _instagram_fallback_dir(url))
+        match = _INSTAGRAM_SHORTCODE.search(url)
+        if match:
+            paths.add(Path(DOWNLOAD_FOLDER) / match.group(1))
+    return paths
+
+
+def _cleanup_leftovers(dead_urls: list[str], live_urls: list[str]):
+    """Удаление файлов незавершённых задач, которые уже не будут повторены.
+
+    Каталоги упавших задач удаляются целиком. Недокачанные .part/.ytdl yt-dlp оставляет
+    для продолжения, поэтому сохраняются только в каталогах повторяемых задач, а в корне
+    DOWNLOAD_FOLDER (TikTok, имя по заголовку) — только если повторяется задача TikTok.
+    Файлы сегментированного скачивания продолжить нельзя — они удаляются всегда.
+    """
+    live = set()
+    for url in live_urls:
+        live |= _job_leftover_paths(url)
+    keep_root_parts = any('instagram.com' not in url for url in live_urls)
+
+    removed = 0
+    for url in dead_urls:
+        for path in _job_leftover_paths(url) - live:
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+
+    root = Path(DOWNLOAD_FOLDER)
+    for pattern in ("*.part", "*.ytdl", "*/*.part", "*/*.ytdl", "*" + _SEGMENTED_SUFFIX, "*/*" + _SEGMENTED_SUFFIX):
+        for path in root.glob(pattern):
+            resumable = path.suffix != _SEGMENTED_SUFFIX
+            if resumable and ((path.parent == root and keep_root_parts) or path.parent in live):
+                continue
+            try:
+                path.unlink()
+                removed += 1
+            except OSError:
+                pass
+
+    if removed:
+        logger.info("Removed %d leftover download(s)", removed)
+
+
+async def _replay_jobs(bot):
+    """Повторный запуск задач, которые не успели завершиться до перезапуска"""
+    _journal.prune(24 * 3600)
+
+    jobs = await _journal.unfinished()
+    if jobs:
+        logger.info("Replaying %d unfinished job(s) from the journal", len(jobs))
+
+    # Одно статус-сообщение на исходное сообщение пользователя, как и при обычной обработке
+    batches: dict[tuple[int, int], list[dict]] = {}
+    # Задачи, часть файлов которых уже доставлена: повтор с нуля прислал бы их ещё раз
+    interrupted: dict[tuple[int, int], list[dict]] = {}
+    for job in jobs:
+        key = (job["chat_id"], job["message_id"])
+        if job["sent"]:
+            logger.info("Job %s was interrupted after sending %d file(s), not replaying", job["id"], job["sent"])
+            _journal.set_stage(job["id"], JOB_FAILED)
+            interrupted.setdefault(key, []).append(job)
+            continue
+        if job["attempts"] >= JOB_MAX_REPLAYS:
+            logger.info("Job %s exceeded %d replays, dropping", job["id"], JOB_MAX_REPLAYS)
+            _journal.set_stage(job["id"], JOB_FAILED)
+            continue
+        _journal.mark_replayed(job["id"])
+        batches.setdefault(key, []).append(job)
+
+    # Файлы упавших и брошенных задач больше никому не нужны
+    live_urls = [job["url"] for batch in batches.values() for job in batch]
+    await asyncio.to_thread(_cleanup_leftovers, await _journal.failed_urls(), live_urls)
+
+    for key, partial in interrupted.items():
+        if key in batches:
+            continue
+        message = _journal_message(bot, partial[0])
+        try:
+            await message.reply_text(
+                "⚠️ Бот перезапустился во время отправки. Часть файлов уже отправлена выше — "
+                "пришлите ссылку ещё раз, чтобы получить остальные."
+            )
+        except Exception as e:
+            logger.info("Cannot notify chat %s about interrupted jobs: %s", partial[0]["chat_id"], e)
+
+    if not batches:
+        return
+
+    # Кулдаун Instagram соблюдаем и при повторном запуске: по всем задачам пользователя
+    now = time.time()
+    ig_urls_by_user: dict[int, list[str]] = {}
+    for batch in batches.values():
+        for job in batch:
+            if 'instagram.com' in job["url"]:
+                ig_urls_by_user.setdefault(job["user_id"] or job["chat_id"], []).append(job["url"])
+    start_at = {}
+    for urls in ig_urls_by_user.values():
+        start_at.update(_instagram_start_times(urls, now))
+
+    async def _replay(batch: list[dict]):
+        message = _journal_message(bot, batch[0])
+        try:
+            status_msg = await message.reply_text("♻️ Бот перезапустился, продолжаю скачивание...")
+        except Exception as e:
+            logger.info("Cannot resume jobs for chat %s: %s", batch[0]["chat_id"], e)
+            for job in batch:
+                _journal.set_stage(job["id"], JOB_FAILED)
+            return
+
+        partial = interrupted.get((batch[0]["chat_id"], batch[0]["message_id"]), [])
+        progress = _BatchProgress(status_msg, [job["url"] for job in partial + batch])
+        for job in partial:
+            await progress.set(
+                job["url"],
+                f"⚠️ Отправка прервана перезапуском: отправлено {job['sent']} файл(ов). "
+                "Пришлите ссылку ещё раз за остальными.",
+                ok=False,
+            )
+        jobs_by_url = {job["url"]: job["id"] for job in batch}
+        await _run_batch(message, batch[0]["user_id"] or batch[0]["chat_id"], progress, jobs_by_url, start_at)
+
+    async def _traced_replay(batch: list[dict]):
+        with _trace("replay", chat_id=batch[0]["chat_id"], jobs=len(batch)):
+            await _replay(batch)
+
+    await asyncio.gather(*(_traced_replay(batch) for batch in batches.values()))
+
+
+# ========== INLINE-РЕЖИМ ==========
+
+# id результата-заглушки -> ссылка (нужна, когда пользователь выберет результат)
+_inline_result_urls: OrderedDict[str, str] = OrderedDict()
+# ключ ссылки -> фоновая загрузка для inline-режима
+_inline_tasks: dict[str, asyncio.Task] = {}
+
+
+def _inline_result_id(url: str) -> str:
+    # id результата в Telegram ограничен 64 байтами
+    return hashlib.sha1(_media_cache_key(url).encode("utf-8")).hexdigest()
+
+
+def _cached_inline_results(url: str, entries: list[tuple[str, str]]) -> list:
+    base_id = _inline_result_id(url)[:32]
+    results = []
+    for idx, (kind, file_id) in enumerate(entries, start=1):
+        result_id = f"{base_id}_{idx}"
+        caption = _MEDIA_CAPTIONS[kind]
+        if kind == "video":
+            results.append(
+                InlineQueryResultCachedVideo(result_id, file_id, title=f"🎬 Видео {idx}", caption=caption)
+            )
+        elif kind == "photo":
+            results.append(InlineQueryResultCachedPhoto(result_id, file_id, caption=caption))
+        elif kind == "animation":
+            results.append(
+                InlineQueryResultCachedMpeg4Gif(result_id, file_id, title=f"🎬 Видео {idx}", caption=caption)
+            )
+        else:
+            results.append(
+                InlineQueryResultCachedDocument(result_id, f"📎 Файл {idx}", file_id, caption=caption)
+            )
+    return results
+
+
+async def _upload_for_inline(bot, chat_id: int | str, path: str, is_instagram: bool, cleanup_paths: set[str]):
+    """Загрузка файла в служебный чат ради file_id (новый файл в inline-сообщение загрузить нельзя)"""
+    send_path, kind = await asyncio.to_thread(_prepare_media, path, is_instagram, cleanup_paths)
+    video_meta = None
+    if kind == "video":
+        send_path, video_meta = await _prepare_video(send_path, cleanup_paths)
+
+    data = await asyncio.to_thread(_read_media_file, send_path)
+    with _span("upload.inline", kind=kind, bytes=len(data)):
+        send = getattr(bot, f"send_{kind}")
+        sent = await send(
+            chat_id=chat_id,
+            disable_notification=True,
+            **_media_kwargs(kind, data, os.path.basename(send_path), video_meta),
+        )
+
+    kind, file_id = _sent_media_entry(sent, kind)
+
+    if not INLINE_CACHE_CHAT_ID:
+        # Загружали в личный чат пользователя: file_id остаётся валидным и после удаления
+        try:
+            await sent.delete()
+        except Exception:
+            pass
+
+    return kind, file_id
+
+
+async def _prefetch_for_inline(bot, url: str, user_id: int) -> list[tuple[str, str]]:
+    cleanup_paths = set()
+    try:
+        async with _admission.slot((user_id, user_id), _job_class(url)):
+            with _span("inline.prefetch", url=url):
+                valid_paths, is_instagram = await _download_media(url)
+        cleanup_paths.update(valid_paths)
+
+        chat_id = INLINE_CACHE_CHAT_ID or user_id
+        entries = []
+        sizes = await asyncio.to_thread(_file_sizes, valid_paths)
+        for path, size in zip(valid_paths, sizes):
+            if size > 50 * 1024 * 1024:
+                continue
+            kind, file_id = await _upload_for_inline(bot, chat_id, path, is_instagram, cleanup_paths)
+            if file_id:
+                entries.append((kind, file_id))
+
+        _media_cache_put(url, entries)
+        return entries
+
+    except Exception:
+        logger.exception("Inline prefetch failed for %s", url)
+        return []
+
+    finally:
+        await asyncio.to_thread(_remove_files, cleanup_paths)
+
+
+# Ссылки, по которым уже можно скачивать: пост/рилс с кодом, видео TikTok с id или короткая
+# ссылка. Inline-запросы приходят на каждый набранный символ — обрывки вроде
+# https://www.tiktok.com/@u не должны ставить загрузки в очередь
+_COMPLETE_MEDIA_URLS = [
+    re.compile(r'instagram\.com/(?:[^/?#]+/)?(?:p|reels?|tv)/[A-Za-z0-9_-]{10,}'),
+    re.compile(r'instagram\.com/stories/[^/?#]+/\d{10,}'),
+    re.compile(r'tiktok\.com/@[^/?#]+/(?:video|photo)/\d{15,}'),
+    re.compile(r'(?:vm|vt)\.tiktok\.com/[A-Za-z0-9]{8,}'),
+    re.compile(r'tiktok\.com/t/[A-Za-z0-9]{8,}'),
+]
+
+
+def _is_complete_media_url(url: str) -> bool:
+    return any(p.search(url) for p in _COMPLETE_MEDIA_URLS)
+
+
+def _start_inline_prefetch(bot, url: str, user_id: int) -> asyncio.Task:
+    # Одна фоновая загрузка на ссылку, сколько бы запросов ни пришло, пока она идёт
+    key = _media_cache_key(url)
+    task = _inline_tasks.get(key)
+    if task is None:
+        task = asyncio.create_task(_prefetch_for_inline(bot, url, user_id))
+        _inline_tasks[key] = task
+        task.add_done_callback(lambda _t: _inline_tasks.pop(key, None))
+    return task
+
+
+@_traced("inline_query")
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик inline-запросов: @bot <ссылка>"""
+    query = update.inline_query
+    urls = _extract_urls(query.query)
+
+    if not urls:
+        await query.answer([], cache_time=5)
+        return
+
+    url = urls[0]
+
+    cached = _media_cache_get(url)
+    if cached:
+        await query.answer(_cached_inline_results(url, cached), cache_time=300)
+        return
+
+    # Ссылка ещё набирается
+    if not _is_complete_media_url(url):
+        await query.answer([], cache_time=5)
+        return
+
+    failure = _negative_cache_get(url)
+    if failure:
+        unavailable = InlineQueryResultArticle(
+            id="unavailable",
+            title=_FAILURE_MESSAGES[failure],
+            description=url,
+            input_message_content=InputTextMessageContent(url),
+        )
+        await query.answer([unavailable], cache_time=0, is_personal=True)
+        return
+
+    # Кулдаун Instagram, если загрузка этой ссылки ещё не идёт. Отсчёт кулдауна начинается,
+    # когда пользователь выберет результат (chosen_inline_result), а не от каждого запроса
+    if 'instagram.com' in url and _media_cache_key(url) not in _inline_tasks:
+        now = time.time()
+        last_ig = float(context.user_data.get("ig_last_ts", 0) or 0)
+        remaining = INSTAGRAM_COOLDOWN_SECONDS - (now - last_ig)
+        if remaining > 0:
+            cooldown = InlineQueryResultArticle(
+                id="ig_cooldown",
+                title=f"⏳ Подождите {int(remaining)} сек",
+                description="перед следующим скачиванием из Instagram",
+                input_message_content=InputTextMessageContent(url),
+            )
+            await query.answer([cooldown], cache_time=0, is_personal=True)
+            return
+
+    _start_inline_prefetch(context.bot, url, query.from_user.id)
+
+    result_id = _inline_result_id(url)
+    _inline_result_urls[result_id] = url
+    _inline_result_urls.move_to_end(result_id)
+    while len(_inline_result_urls) > max(100, SENT_MEDIA_CACHE_SIZE):
+        _inline_result_urls.popitem(last=False)
+
+    placeholder = InlineQueryResultArticle(
+        id=result_id,
+        title="⏳ Скачать медиа",
+        description=url,
+        input_message_content=InputTextMessageContent(f"⏳ Скачиваю медиа...\n{url}"),
+        # Клавиатура обязательна: без неё Telegram не вернёт inline_message_id для редактирования
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔗 Оригинал", url=url)]]),
+    )
+    await query.answer([placeholder], cache_time=0, is_personal=True)
+
+
+@_traced("chosen_inline_result")
+async def chosen_inline_result(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Подмена заглушки на медиа после фоновой загрузки"""
+    chosen = update.chosen_inline_result
+    inline_message_id = chosen.inline_message_id
+    url = _inline_result_urls.get(chosen.result_id)
+
+    # Результаты из кэша сразу содержат медиа — редактировать нечего
+    if not inline_message_id or not url:
+        return
+
+    if 'instagram.com' in url:
+        context.user_data["ig_last_ts"] = time.time()
+
+    entries = _media_cache_get(url)
+    if not entries:
+        task = _start_inline_prefetch(context.bot, url, chosen.from_user.id)
+        entries = await task
+
+    if not entries:
+        failure = _negative_cache_get(url)
+        await context.bot.edit_message_text(
+            _FAILURE_MESSAGES.get(failure, "❌ Не удалось скачать медиа. Попробуйте другую ссылку."),
+            inline_message_id=inline_message_id,
+        )
+        return
+
+    # В inline-сообщение помещается только одно медиа (для карусели — первое)
+    kind, file_id = entries[0]
+    media_cls = {
+        "video": InputMediaVideo,
+        "photo": InputMediaPhoto,
+        "document": InputMediaDocument,
+        "animation": InputMediaAnimation,
+    }[kind]
+    await context.bot.edit_message_media(
+        media=media_cls(media=file_id, caption=_MEDIA_CAPTIONS[kind]),
+        inline_message_id=inline_message_id,
+    )
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -993,8 +3395,480 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     )
 
 
+# ========== ОЧЕРЕДЬ ИСХОДЯЩИХ ЗАПРОСОВ ==========
+
+# Чем меньше число, тем раньше запрос уходит в API: медиа важнее косметики статуса
+_SEND_PRIORITIES = {
+    "sendVideo": 0,
+    "sendPhoto": 0,
+    "sendDocument": 0,
+    "sendAnimation": 0,
+    "sendMediaGroup": 0,
+    "editMessageMedia": 0,
+    "answerInlineQuery": 1,
+    "answerCallbackQuery": 1,
+    "sendMessage": 1,
+    "editMessageText": 2,
+    "editMessageReplyMarkup": 2,
+    "deleteMessage": 2,
+}
+
+
+def _retry_after_seconds(exc: RetryAfter) -> float:
+    retry_after = exc.retry_after
+    if isinstance(retry_after, dt.timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class _TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = max(rate, 1e-6)
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self, now: float) -> bool:
+        """Полное ведро без блокировки ведёт себя как новое — его можно выбросить"""
+        self._refill(now)
+        return self.tokens >= self.burst and self.blocked_until <= now
+
+
+class _SendScheduler(BaseRateLimiter):
+    """Глобальный и початовый лимит запросов к Bot API с приоритетами и обработкой RetryAfter"""
+
+    def __init__(
+        self,
+        global_rate: float,
+        chat_rate: float,
+        group_rate_per_minute: float,
+        max_retries: int,
+    ):
+        self.global_bucket = _TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate_per_minute / 60
+        self.max_retries = max(0, max_retries)
+        self._chat_buckets: dict[int | str, _TokenBucket] = {}
+        self._buckets_sweep_at = _CHAT_STATE_SWEEP_SIZE
+        # (приоритет, порядковый номер, чат, future) — запросы, ждущие разрешения
+        self._waiters: list[tuple[int, int, int | str | None, asyncio.Future]] = []
+        self._seq = 0
+        self._wakeup: asyncio.Event | None = None
+        self._dispatcher: asyncio.Task | None = None
+
+    async def initialize(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for _, _, _, fut in self._waiters:
+            if not fut.done():
+                fut.cancel()
+        self._waiters.clear()
+
+    def _chat_bucket(self, chat_key: int | str) -> _TokenBucket:
+        bucket = self._chat_buckets.get(chat_key)
+        if bucket is None:
+            self._sweep_chat_buckets()
+            # Группы и каналы (отрицательный id или @username) ограничены строже личных чатов
+            if isinstance(chat_key, str) or chat_key < 0:
+                bucket = _TokenBucket(self.group_rate, 3)
+            else:
+                bucket = _TokenBucket(self.chat_rate, 3)
+            self._chat_buckets[chat_key] = bucket
+        return bucket
+
+    def _sweep_chat_buckets(self):
+        if len(self._chat_buckets) < self._buckets_sweep_at:
+            return
+        now = time.monotonic()
+        for chat_key, bucket in list(self._chat_buckets.items()):
+            if bucket.idle(now):
+                del self._chat_buckets[chat_key]
+        self._buckets_sweep_at = max(_CHAT_STATE_SWEEP_SIZE, 2 * len(self._chat_buckets))
+
+    async def _acquire(self, priority: int, chat_key: int | str | None):
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        self._waiters.append((priority, self._seq, chat_key, fut))
+        self._wakeup.set()
+        await fut
+
+    async def _dispatch_loop(self):
+        while True:
+            now = time.monotonic()
+            next_wake = None
+            granted = False
+
+            self._waiters = [w for w in self._waiters if not w[3].done()]
+            global_wait = self.global_bucket.wait_time(now)
+
+            if self._waiters and global_wait > 0:
+                next_wake = global_wait
+            elif self._waiters:
+                # Первый по приоритету запрос, чей чат ещё не исчерпал лимит
+                for waiter in sorted(self._waiters, key=lambda w: (w[0], w[1])):
+                    _, _, chat_key, fut = waiter
+                    wait = self._chat_bucket(chat_key).wait_time(now) if chat_key is not None else 0.0
+                    if wait > 0:
+                        next_wake = wait if next_wake is None else min(next_wake, wait)
+                        continue
+
+                    self.global_bucket.take(now)
+                    if chat_key is not None:
+                        self._chat_bucket(chat_key).take(now)
+                    self._waiters.remove(waiter)
+                    fut.set_result(None)
+                    granted = True
+                    break
+
+            if granted:
+                continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=next_wake)
+            except asyncio.TimeoutError:
+                pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        # rate_limit_args позволяет явно задать приоритет конкретного вызова
+        if isinstance(rate_limit_args, int):
+            priority = rate_limit_args
+        else:
+            priority = _SEND_PRIORITIES.get(endpoint, 1)
+
+        chat_key = data.get("chat_id")
+        try:
+            chat_key = int(chat_key)
+        except (TypeError, ValueError):
+            pass
+
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(priority, chat_key)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                if attempt == self.max_retries:
+                    raise
+
+                delay = _retry_after_seconds(exc) + 0.1
+                logger.warning("Flood control on %s (chat %s), retry in %.1f s", endpoint, chat_key, delay)
+
+                # Ждём вместо ошибки: блокируем чат (или весь бот для запросов без чата)
+                if chat_key is not None:
+                    self._chat_bucket(chat_key).block(delay)
+                else:
+                    self.global_bucket.block(delay)
+                self._wakeup.set()
+
+
+# ========== СТОРОЖ EVENT LOOP ==========
+
+class _LoopWatchdog:
+    """Задержка планирования event loop и стеки вызовов, надолго занявших loop.
+
+    Корутина-сторож спит interval и меряет, насколько позже проснулась: это и есть
+    задержка, которую видят все чаты. В отладочном режиме отдельный поток следит за
+    пульсом сторожа и, если loop занят дольше block_threshold, снимает стек потока loop.
+    """
+
+    def __init__(self, interval: float, warn_threshold: float, block_threshold: float, debug: bool):
+        self.debug = debug
+        self.block_threshold = max(0.01, block_threshold)
+        # Пульс должен быть чаще порога блокировки, иначе поток-сторож не отличит паузу от сна
+        self.interval = min(interval, self.block_threshold / 2) if debug else interval
+        self.warn_threshold = warn_threshold
+        self.lags: deque[float] = deque(maxlen=2048)
+        self.ticks = 0
+        self.slow_ticks = 0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.blockers: Counter[str] = Counter()
+        self.heartbeat = time.monotonic()
+        self._loop_thread_id = None
+
+    async def run(self):
+        self._loop_thread_id = threading.get_ident()
+        # Пульс с момента импорта модуля устарел: без сброса первая же проверка
+        # засчитала бы время запуска бота как остановку loop
+        self.heartbeat = time.monotonic()
+        if self.debug:
+            threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+        last_report = time.monotonic()
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.heartbeat = now
+
+            lag = max(0.0, now - expected)
+            self.ticks += 1
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.warn_threshold:
+                self.slow_ticks += 1
+                logger.warning("Event loop lag %.0f ms", lag * 1000)
+
+            if LOOP_METRICS_LOG_SECONDS > 0 and now - last_report >= LOOP_METRICS_LOG_SECONDS:
+                last_report = now
+                snapshot = self.snapshot()
+                logger.info("Event loop: %s", self.report(snapshot))
+                if LOOP_METRICS_PATH:
+                    await asyncio.to_thread(self._write_metrics, snapshot)
+
+    def _watch(self):
+        reported_heartbeat = None
+        while True:
+            time.sleep(self.block_threshold / 4)
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            # Одну остановку loop сообщаем один раз, сколько бы она ни длилась
+            if stalled < self.block_threshold or heartbeat == reported_heartbeat:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            reported_heartbeat = heartbeat
+
+            stack = traceback.extract_stack(frame)
+            del frame
+            location = self._blocker_location(stack)
+            self.stalls += 1
+            self.blockers[location] += 1
+            logger.warning(
+                "Event loop blocked for over %.0f ms at %s\n%s",
+                stalled * 1000,
+                location,
+                "".join(traceback.format_list(stack[-12:])).rstrip(),
+            )
+
+    @staticmethod
+    def _blocker_location(stack: traceback.StackSummary) -> str:
+        # Ближайший к вершине стека кадр из кода бота — обычно он и виноват
+        for entry in reversed(stack):
+            if entry.filename == __file__:
+                return f"{os.path.basename(entry.filename)}:{entry.lineno} in {entry.name}"
+        entry = stack[-1]
+        return f"{entry.filename}:{entry.lineno} in {entry.name}"
+
+    def snapshot(self) -> dict:
+        lags = sorted(self.lags)
+
+        def _percentile(q: float) -> float:
+            return lags[min(len(lags) - 1, int(len(lags) * q))] * 1000 if lags else 0.0
+
+        return {
+            "ticks": self.ticks,
+            "lag_p50_ms": round(_percentile(0.5), 1),
+            "lag_p99_ms": round(_percentile(0.99), 1),
+            "lag_max_ms": round(self.max_lag * 1000, 1),
+            "slow_ticks": self.slow_ticks,
+            "stalls": self.stalls,
+            "blockers": dict(self.blockers.most_common(5)),
+        }
+
+    @staticmethod
+    def report(snapshot: dict) -> str:
+        text = (
+            f"lag p50 {snapshot['lag_p50_ms']} ms, p99 {snapshot['lag_p99_ms']} ms, "
+            f"max {snapshot['lag_max_ms']} ms; slow ticks {snapshot['slow_ticks']}/{snapshot['ticks']}"
+        )
+        if snapshot["stalls"]:
+            blockers = ", ".join(f"{k} x{v}" for k, v in snapshot["blockers"].items())
+            text += f"; stalls {snapshot['stalls']} ({blockers})"
+        return text
+
+    def _write_metrics(self, snapshot: dict):
+        try:
+            tmp_path = LOOP_METRICS_PATH + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({**snapshot, "updated_at": time.time()}, f)
+            os.replace(tmp_path, LOOP_METRICS_PATH)
+        except Exception as e:
+            logger.info("Cannot write loop metrics: %s", e)
+
+
+_loop_watchdog = _LoopWatchdog(
+    interval=LOOP_LAG_INTERVAL_SECONDS,
+    warn_threshold=LOOP_LAG_WARN_SECONDS,
+    block_threshold=LOOP_BLOCK_THRESHOLD_SECONDS,
+    debug=LOOP_DEBUG,
+)
+
+
+# ========== ПРОФИЛИРОВАНИЕ ==========
+
+# Листовые кадры из этих модулей — ожидание (пул потоков, select, очереди), а не работа
+_IDLE_FRAME_FILES = ("threading.py", "selectors.py", "queue.py", "thread.py", "base_events.py")
+
+_profiler_running = False
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _sample_stacks(seconds: float, interval: float) -> tuple[Counter, int]:
+    """Сэмплирующий профайлер: раз в interval снимает стеки всех потоков, кроме своего"""
+    own_ident = threading.get_ident()
+    stacks: Counter[str] = Counter()
+    samples = 0
+    names: dict[int, str] = {}
+    names_at = 0.0
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        now = time.monotonic()
+        if now - names_at >= 1.0:
+            # Номера потоков пула (segment_0, segment_1, ...) склеиваем в одно имя
+            names = {t.ident: re.sub(r'_\d+$', '', t.name) for t in threading.enumerate()}
+            names_at = now
+
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            labels.append(names.get(ident, str(ident)))
+            stacks[";".join(reversed(labels))] += 1
+        samples += 1
+        time.sleep(interval)
+
+    return stacks, samples
+
+
+def _run_profiler(seconds: float) -> tuple[str, str]:
+    """Профилирование в рабочем потоке: (путь к файлу collapsed stacks, краткая сводка)"""
+    started_at = time.monotonic()
+    stacks, samples = _sample_stacks(seconds, PROFILER_INTERVAL_SECONDS)
+
+    profiles_dir = Path(DOWNLOAD_FOLDER) / "profiles"
+    profiles_dir.mkdir(exist_ok=True)
+    path = profiles_dir / f"profile-{dt.datetime.now().strftime('%Y%m%d-%H%M%S')}.folded"
+    # Формат collapsed stacks: «поток;кадр;...;кадр число» — подходит для flamegraph.pl и speedscope
+    with open(path, 'w', encoding='utf-8') as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+    busy: Counter[str] = Counter()
+    for stack, count in stacks.items():
+        leaf = stack.rsplit(";", 1)[-1]
+        if not any(f"({name}:" in leaf for name in _IDLE_FRAME_FILES):
+            busy[leaf] += count
+    busy_total = sum(busy.values())
+
+    lines = [
+        f"🔬 Профиль за {time.monotonic() - started_at:.0f} сек: {samples} срезов, "
+        f"{sum(stacks.values())} стеков, активных {busy_total}"
+    ]
+    for leaf, count in busy.most_common(10):
+        lines.append(f"{count * 100 / max(busy_total, 1):5.1f}% {leaf}")
+    return str(path), "\n".join(lines)
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /profile [секунды] (только для администраторов)"""
+    global _profiler_running
+
+    user = update.effective_user
+    if user is None or user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("⛔ Команда доступна только администраторам бота.")
+        return
+
+    try:
+        seconds = float(context.args[0]) if context.args else PROFILER_DEFAULT_SECONDS
+    except ValueError:
+        await update.message.reply_text("Использование: /profile [секунды]")
+        return
+    seconds = min(max(1.0, seconds), PROFILER_MAX_SECONDS)
+
+    if _profiler_running:
+        await update.message.reply_text("⏳ Профилирование уже идёт.")
+        return
+
+    _profiler_running = True
+    try:
+        await update.message.reply_text(f"🔬 Профилирую {seconds:.0f} сек...")
+        path, summary = await asyncio.to_thread(_run_profiler, seconds)
+        with open(path, 'rb') as profile_file:
+            await update.message.reply_document(
+                profile_file,
+                filename=os.path.basename(path),
+                caption=summary[:1024],
+            )
+    finally:
+        _profiler_running = False
+
+
 # ========== ЗАПУСК БОТА ==========
 
+# Ссылки на фоновые задачи, чтобы их не собрал GC
+_background_tasks: set[asyncio.Task] = set()
+
+# Метрики запуска (секунды от старта процесса)
+_startup_metrics: dict[str, float] = {}
+
+
+def _mark_startup(name: str):
+    if name not in _startup_metrics:
+        _startup_metrics[name] = time.monotonic() - _STARTED_AT
+        logger.info("Startup: %s at %.3f s", name, _startup_metrics[name])
+
+
+def _warm_up_imports():
+    """Фоновый прогрев тяжёлых зависимостей и пула YoutubeDL, чтобы первый запрос не платил за них"""
+    if WARMUP_DELAY_SECONDS > 0:
+        time.sleep(WARMUP_DELAY_SECONDS)
+
+    started_at = time.monotonic()
+    try:
+        import requests  # noqa: F401
+        import yt_dlp  # noqa: F401
+
+        _pil_image()
+        _prewarm_ytdlp_pool()
+    except Exception:
+        logger.exception("Warm-up imports failed")
+        return
+    logger.info("Warm-up imports done in %.3f s", time.monotonic() - started_at)
+    _mark_startup("warm_up_done")
+
+
+async def record_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _mark_startup("first_update")
+
+
 async def set_bot_commands(application: Application):
     commands = [
         BotCommand("start", "Start the bot / Запуск бота"),
@@ -1002,16 +3876,76 @@ async def set_bot_commands(application: Application):
     ]
     await application.bot.set_my_commands(commands)
 
+    # Админские команды видны только в личных чатах администраторов
+    admin_commands = commands + [BotCommand("profile", "Profile the bot / Профилирование бота")]
+    for admin_id in ADMIN_USER_IDS:
+        try:
+            await application.bot.set_my_commands(admin_commands, scope=BotCommandScopeChat(admin_id))
+        except Exception as e:
+            logger.info("Cannot set admin commands for %s: %s", admin_id, e)
+
+
+async def post_init(application: Application):
+    await set_bot_commands(application)
+
+    if WARMUP_DELAY_SECONDS >= 0:
+        threading.Thread(target=_warm_up_imports, name="warm-up", daemon=True).start()
+
+    # Незавершённые задачи из журнала продолжаем в фоне, не задерживая старт polling
+    task = asyncio.create_task(_replay_jobs(application.bot))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+    if LOOP_LAG_INTERVAL_SECONDS > 0:
+        task = asyncio.create_task(_loop_watchdog.run())
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+    _mark_startup("polling_starting")
+
 
 def main():
     """Запуск бота"""
-    application = Application.builder().token(BOT_TOKEN).post_init(set_bot_commands).build()
+    # Проверяем конфигурацию до построения Application
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN is not set. Please set it in .env or as an environment variable.")
+
+    _mark_startup("module_imported")
+
+    send_scheduler = _SendScheduler(
+        global_rate=TELEGRAM_GLOBAL_RATE,
+        chat_rate=TELEGRAM_CHAT_RATE,
+        group_rate_per_minute=TELEGRAM_GROUP_RATE_PER_MINUTE,
+        max_retries=TELEGRAM_MAX_RETRIES,
+    )
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .rate_limiter(send_scheduler)
+        .post_init(post_init)
+        # Апдейты обрабатываются параллельно: длинное скачивание одного пользователя
+        # не задерживает остальных, порядок и лимиты задаёт очередь допуска
+        .concurrent_updates(max(1, CONCURRENT_UPDATES))
+    )
+    if TELEGRAM_API_BASE_URL:
+        base_url = TELEGRAM_API_BASE_URL.rstrip('/')
+        builder = builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+    application = builder.build()
+    _mark_startup("application_built")
+
+    # Метрика времени до первого апдейта (группа -1 выполняется раньше остальных обработчиков)
+    application.add_handler(TypeHandler(Update, record_first_update), group=-1)
 
     # Регистрируем обработчики команд
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("profile", profile_command))
     application.add_handler(CallbackQueryHandler(language_callback, pattern="^lang_"))
 
+    # Inline-режим (нужно включить /setinline и /setinlinefeedback у @BotFather)
+    application.add_handler(InlineQueryHandler(inline_query))
+    application.add_handler(ChosenInlineResultHandler(chosen_inline_result))
+
     # Регистрируем обработчик текстовых сообщений
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
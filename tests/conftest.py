@@ -0,0 +1,19 @@
+import os
+import shutil
+import sys
+import tempfile
+
+# download.py — модуль в корне репозитория, не пакет: делаем его импортируемым и из
+# `pytest`, и из `python -m pytest`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Импорт download создаёт DOWNLOAD_FOLDER и пишет туда журнал задач и трейсы —
+# в тестах всё это уходит во временный каталог, а не в ./downloads
+_download_folder = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ["DOWNLOAD_FOLDER"] = _download_folder
+os.environ["JOB_JOURNAL_PATH"] = os.path.join(_download_folder, "jobs.sqlite3")
+os.environ["TRACE_JSONL_PATH"] = os.path.join(_download_folder, "traces.jsonl")
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(_download_folder, ignore_errors=True)
@@ -0,0 +1,111 @@
+import asyncio
+
+import download
+
+
+def _queue(max_inflight=1, instagram=1):
+    return download._AdmissionQueue(max_inflight, {"instagram": instagram}, {}, 20)
+
+
+async def _run_jobs(queue, jobs, on_position=None):
+    """jobs: [(flow, job_class, name)] — порядок, в котором задачи получили слот"""
+    order = []
+    gate = asyncio.Event()
+
+    async def _job(flow, job_class, name):
+        async with queue.slot(flow, job_class, on_position):
+            order.append(name)
+            await gate.wait()
+
+    tasks = [asyncio.create_task(_job(*job)) for job in jobs]
+    await asyncio.sleep(0)
+    gate.set()
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_flows_are_interleaved():
+    async def main():
+        queue = _queue()
+        jobs = [((1, 1), "tiktok", f"a{i}") for i in range(3)] + [((2, 2), "tiktok", f"b{i}") for i in range(3)]
+        return await _run_jobs(queue, jobs)
+
+    assert asyncio.run(main()) == ["a0", "b0", "a1", "b1", "a2", "b2"]
+
+
+def test_class_limit_lets_other_class_pass():
+    async def main():
+        queue = _queue(max_inflight=2, instagram=1)
+        started = []
+        release = asyncio.Event()
+
+        async def _job(flow, job_class, name):
+            async with queue.slot(flow, job_class):
+                started.append(name)
+                await release.wait()
+
+        tasks = [
+            asyncio.create_task(_job((1, 1), "instagram", "ig1")),
+            asyncio.create_task(_job((2, 2), "instagram", "ig2")),
+            asyncio.create_task(_job((3, 3), "tiktok", "tt")),
+        ]
+        await asyncio.sleep(0.01)
+        running = list(started)
+        release.set()
+        await asyncio.gather(*tasks)
+        return running, queue.inflight, queue.queued
+
+    running, inflight, queued = asyncio.run(main())
+    assert running == ["ig1", "tt"]
+    assert (inflight, queued) == (0, 0)
+
+
+def test_cancelled_waiter_is_skipped():
+    async def main():
+        queue = _queue()
+        order = []
+        release = asyncio.Event()
+
+        async def _job(flow, name):
+            async with queue.slot(flow, "tiktok"):
+                order.append(name)
+                await release.wait()
+
+        first = asyncio.create_task(_job((1, 1), "first"))
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(_job((2, 2), "cancelled"))
+        last = asyncio.create_task(_job((3, 3), "last"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, last)
+        return order, queue.queued, queue.inflight
+
+    order, queued, inflight = asyncio.run(main())
+    assert order == ["first", "last"]
+    assert (queued, inflight) == (0, 0)
+
+
+def test_positions_reported_only_to_listeners():
+    async def main():
+        queue = _queue()
+        positions = []
+
+        async def on_position(position, eta):
+            positions.append(position)
+
+        release = asyncio.Event()
+
+        async def _job(flow, listener):
+            async with queue.slot(flow, "tiktok", listener):
+                await release.wait()
+
+        tasks = [asyncio.create_task(_job((i, i), on_position if i == 3 else None)) for i in range(4)]
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(*tasks)
+        return positions
+
+    # Задача 0 сразу получила слот; слушатель — третья в очереди
+    assert asyncio.run(main())[0] == 3
@@ -0,0 +1,120 @@
+import pytest
+
+import download
+
+
+IG_ASSET = "464939212_1096612718576447_3395478069446467185_n"
+IG_QUERY = (
+    "_nc_ht=scontent-fra5-2.cdninstagram.com&_nc_cat=107&_nc_ohc=Qm2pLx7SdGIQ7kNvgFq3Jxa"
+    "&_nc_gid=a4c1b8f2e5d34a6b9c0e7f1d2a3b4c5d&edm=APs17CUBAAAA&ccb=7-5"
+    "&oh=00_AYBxK3m1q9vN0sTzR2wLhJ7c5aE8fD6gH4iU2oP1yQ3rXw&oe=6729F0C1&_nc_sid=10d13b"
+)
+
+# Оригинал: ни маркера размера, ни кропа
+IG_ORIGINAL = (
+    f"https://scontent-fra5-2.cdninstagram.com/v/t51.29350-15/{IG_ASSET}.jpg"
+    f"?efg=eyJ2ZW5jb2RlX3RhZyI6ImltYWdlX3VybGdlbi4xNDQweDE4MDAuc2RyLmYyOTM1MC5kZWZhdWx0X2ltYWdlIn0&{IG_QUERY}"
+)
+IG_P1080 = (
+    f"https://scontent-fra5-2.cdninstagram.com/v/t51.29350-15/{IG_ASSET}.jpg"
+    f"?stp=dst-jpg_e35_p1080x1080_sh0.08&{IG_QUERY}"
+)
+IG_S640 = (
+    f"https://scontent-fra5-1.cdninstagram.com/v/t51.29350-15/{IG_ASSET}.jpg"
+    f"?stp=dst-jpg_e35_s640x640_sh0.08&{IG_QUERY}"
+)
+IG_CROPPED_FBCDN = (
+    f"https://instagram.fhel6-1.fna.fbcdn.net/v/t51.2885-15/{IG_ASSET}.jpg"
+    f"?stp=c0.180.1440.1440a_dst-jpg_e35_s240x240&{IG_QUERY}"
+)
+IG_OLD_PATH_CROPPED = (
+    "https://scontent-arn2-1.cdninstagram.com/vp/5e1e7b3fe9e6c5ab5bfe1f2c1e0d5e2c/5D8F8A2B/"
+    "t51.2885-15/e35/c0.135.1080.1080a/s150x150/66418541_2368853226770412_5208425563936432519_n.jpg"
+    "?_nc_ht=scontent-arn2-1.cdninstagram.com"
+)
+IG_OLD_PATH_SIZED = (
+    "https://scontent-arn2-1.cdninstagram.com/vp/7c2d9a41b8e3f0c6d5a4b3e2f1a0c9d8/5D8F8A2B/"
+    "t51.2885-15/sh0.08/e35/s1080x1080/66418541_2368853226770412_5208425563936432519_n.jpg"
+    "?_nc_ht=scontent-arn2-1.cdninstagram.com"
+)
+
+TT_ASSET = "3a8c1e0f9b2d4e6f8a1c3e5b7d9f0a2c"
+TT_QUERY = "x-expires=1729760400&x-signature=0bT6k3%2FqJ9xR1mL8sVwZp4yNcE0%3D"
+TT_ORIGINAL = f"https://p16-sign-va.tiktokcdn.com/tos-maliva-i-photomode-us/{TT_ASSET}~tplv-photomode-image.jpeg?{TT_QUERY}"
+TT_ZOOMCOVER = (
+    f"https://p77-sign-va.tiktokcdn.com/tos-maliva-i-photomode-us/{TT_ASSET}"
+    f"~tplv-photomode-zoomcover:720:720.jpeg?{TT_QUERY}"
+)
+TT_US_ASSET = "oUAIe7gEBQfDAiFEqAjLgQbQqfHEAAnvIBQSg1"
+TT_US_ORIGIN = (
+    f"https://p16-sign-useast2a.tiktokcdn.com/obj/tos-useast5-p-0068-tx/{TT_US_ASSET}"
+    f"~tplv-tiktokx-origin.image?dr=14575&{TT_QUERY}"
+)
+TT_US_720 = f"https://p16-sign-useast2a.tiktokcdn.com/tos-useast5-p-0068-tx/{TT_US_ASSET}~c5_720x720.jpeg?{TT_QUERY}"
+
+
+@pytest.mark.parametrize(
+    "url, expected",
+    [
+        (IG_ORIGINAL, ("fbcdn:" + IG_ASSET, 0, 0, False, True)),
+        (IG_P1080, ("fbcdn:" + IG_ASSET, 1080, 1080, False, False)),
+        (IG_S640, ("fbcdn:" + IG_ASSET, 640, 640, False, False)),
+        (IG_CROPPED_FBCDN, ("fbcdn:" + IG_ASSET, 240, 240, True, False)),
+        (IG_OLD_PATH_CROPPED, ("fbcdn:66418541_2368853226770412_5208425563936432519_n", 150, 150, True, False)),
+        (IG_OLD_PATH_SIZED, ("fbcdn:66418541_2368853226770412_5208425563936432519_n", 1080, 1080, False, False)),
+        (TT_ORIGINAL, (f"tiktok:tos-maliva-i-photomode-us/{TT_ASSET}", 0, 0, False, True)),
+        (TT_ZOOMCOVER, (f"tiktok:tos-maliva-i-photomode-us/{TT_ASSET}", 720, 720, True, False)),
+        (TT_US_ORIGIN, (f"tiktok:tos-useast5-p-0068-tx/{TT_US_ASSET}", 0, 0, False, True)),
+        (TT_US_720, (f"tiktok:tos-useast5-p-0068-tx/{TT_US_ASSET}", 720, 720, False, False)),
+        ("https://www.instagram.com/p/C9xKq2LtP4m/", None),
+    ],
+)
+def test_cdn_candidate(url, expected):
+    assert download._cdn_candidate(url) == expected
+
+
+@pytest.mark.parametrize(
+    "urls",
+    [
+        [IG_S640, IG_ORIGINAL],
+        [IG_ORIGINAL, IG_S640],
+        [IG_P1080, IG_S640, IG_CROPPED_FBCDN, IG_ORIGINAL],
+    ],
+)
+def test_unsized_fbcdn_original_wins(urls):
+    assert download._resolve_cdn_candidates(urls) == [IG_ORIGINAL]
+
+
+def test_uncropped_beats_larger_crop():
+    assert download._resolve_cdn_candidates([IG_OLD_PATH_CROPPED, IG_OLD_PATH_SIZED]) == [IG_OLD_PATH_SIZED]
+    assert download._resolve_cdn_candidates([IG_CROPPED_FBCDN, IG_S640]) == [IG_S640]
+
+
+def test_tiktok_origin_beats_resized():
+    assert download._resolve_cdn_candidates([TT_ZOOMCOVER, TT_ORIGINAL]) == [TT_ORIGINAL]
+    assert download._resolve_cdn_candidates([TT_US_720, TT_US_ORIGIN]) == [TT_US_ORIGIN]
+
+
+def test_known_sizes_override_url_markers():
+    # p1080x1080 — ограничение по большей стороне, реальный кадр 1080x1350 из config_width/height
+    sizes = {IG_P1080: (1080, 1350), IG_S640: (640, 800)}
+    assert download._resolve_cdn_candidates([IG_S640, IG_P1080], sizes) == [IG_P1080]
+    # Маркер s640x640 при известных 1440x1800 не должен проиграть p1080x1080
+    sizes = {IG_S640: (1440, 1800)}
+    assert download._resolve_cdn_candidates([IG_P1080, IG_S640], sizes) == [IG_S640]
+
+
+def test_one_url_per_asset_in_first_seen_order():
+    page = "https://www.instagram.com/p/C9xKq2LtP4m/?img_index=2"
+    urls = [
+        IG_S640,
+        TT_ZOOMCOVER,
+        IG_OLD_PATH_SIZED,
+        IG_ORIGINAL,
+        TT_ORIGINAL,
+        page,
+        page,
+        "not a url",
+        None,
+    ]
+    assert download._resolve_cdn_candidates(urls) == [IG_ORIGINAL, TT_ORIGINAL, IG_OLD_PATH_SIZED, page]
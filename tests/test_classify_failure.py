@@ -0,0 +1,46 @@
+import socket
+
+import pytest
+import requests
+
+import download
+
+
+def _http_error(status: int, message: str) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(message, response=response)
+
+
+@pytest.mark.parametrize(
+    "errors, expected",
+    [
+        # 5xx и таймауты — временные, даже если в тексте есть "unavailable"
+        ([_http_error(503, "503 Server Error: Service Unavailable for url: https://www.instagram.com/p/C1a2b3c4d5e/")],
+         download.FAILURE_TRANSIENT),
+        (["503 Server Error: Service Unavailable for url: https://www.tiktok.com/@user/video/7301234567890123456"],
+         download.FAILURE_TRANSIENT),
+        ([_http_error(502, "502 Server Error: Bad Gateway")], download.FAILURE_TRANSIENT),
+        ([requests.exceptions.ReadTimeout("HTTPSConnectionPool(host='www.instagram.com', port=443): Read timed out.")],
+         download.FAILURE_TRANSIENT),
+        ([socket.timeout("timed out")], download.FAILURE_TRANSIENT),
+        ([requests.exceptions.ConnectionError("Connection aborted.")], download.FAILURE_TRANSIENT),
+        (["ERROR: [Instagram] C1a2b3c4d5e: Requested format is not available. Use --list-formats for a list of available formats"],
+         download.FAILURE_TRANSIENT),
+        (["ERROR: [Instagram] C1a2b3c4d5e: Requested content is not available, rate-limit reached or login required"],
+         download.FAILURE_TRANSIENT),
+        # Удалённые и несуществующие публикации
+        ([_http_error(404, "404 Client Error: Not Found for url: https://www.instagram.com/p/C1a2b3c4d5e/")],
+         download.FAILURE_NOT_FOUND),
+        (["ERROR: [TikTok] 7301234567890123456: Video not available, status code 10204"], download.FAILURE_NOT_FOUND),
+        (["Sorry, this page isn't available."], download.FAILURE_NOT_FOUND),
+        (["ERROR: [Instagram] C1a2b3c4d5e: This video is unavailable"], download.FAILURE_NOT_FOUND),
+        # Прочее
+        (["ERROR: [TikTok] 7301234567890123456: This account is private"], download.FAILURE_PRIVATE),
+        ([_http_error(401, "401 Client Error: Unauthorized")], download.FAILURE_LOGIN_REQUIRED),
+        (["redirected to https://www.instagram.com/accounts/login/"], download.FAILURE_LOGIN_REQUIRED),
+        (["something odd happened"], download.FAILURE_TRANSIENT),
+    ],
+)
+def test_classify_failure(errors, expected):
+    assert download._classify_failure(errors) == expected
@@ -0,0 +1,25 @@
+import pytest
+
+import download
+
+
+@pytest.mark.parametrize(
+    "url, complete",
+    [
+        ("https://www.tiktok.com/@user/video/7301234567890123456", True),
+        ("https://www.tiktok.com/@user/photo/7301234567890123456?is_from_webapp=1", True),
+        ("https://vm.tiktok.com/ZMhvqjR2x/", True),
+        ("https://www.tiktok.com/t/ZTRvPqk8m/", True),
+        ("https://www.instagram.com/p/C9xKq2LtP4m/", True),
+        ("https://www.instagram.com/reel/C9xKq2LtP4m/?igsh=MWQ1ZGUxMzBkMA==", True),
+        ("https://www.instagram.com/stories/natgeo/3456789012345678901/", True),
+        # Недонабранные ссылки из inline-запросов
+        ("https://www.tiktok.com/@u", False),
+        ("https://www.tiktok.com/@user/video/73012", False),
+        ("https://vm.tiktok.com/ZM", False),
+        ("https://www.instagram.com/p/C9x", False),
+        ("https://www.instagram.com/natgeo/", False),
+    ],
+)
+def test_is_complete_media_url(url, complete):
+    assert download._is_complete_media_url(url) is complete
@@ -0,0 +1,36 @@
+import asyncio
+
+import download
+
+
+def test_reads_see_queued_writes(tmp_path):
+    journal = download._JobJournal(str(tmp_path / "jobs.sqlite3"))
+
+    async def scenario():
+        done = await journal.add(1, "private", 10, 5, "https://example.com/a")
+        failed = await journal.add(1, "private", 10, 5, "https://example.com/b")
+        sent = await journal.add(1, "private", 10, 5, "https://example.com/c")
+        # Записи не ждём: чтения ниже должны увидеть их благодаря общей очереди
+        journal.set_stage(done, download.JOB_DONE)
+        journal.set_stage(failed, download.JOB_FAILED)
+        journal.add_sent(sent)
+        journal.mark_replayed(sent)
+        return await journal.unfinished(), await journal.failed_urls()
+
+    unfinished, failed_urls = asyncio.run(scenario())
+
+    assert [job["url"] for job in unfinished] == ["https://example.com/c"]
+    assert unfinished[0]["sent"] == 1
+    assert unfinished[0]["attempts"] == 1
+    assert failed_urls == ["https://example.com/b"]
+
+
+def test_disabled_journal_is_noop():
+    journal = download._JobJournal(None)
+
+    async def scenario():
+        job_id = await journal.add(1, "private", 10, 5, "https://example.com/a")
+        journal.set_stage(job_id, download.JOB_DONE)
+        return job_id, await journal.unfinished()
+
+    assert asyncio.run(scenario()) == (None, [])
@@ -0,0 +1,43 @@
+from types import SimpleNamespace
+
+import pytest
+
+import download
+
+
+def _message(photo=None, video=None, animation=None, document=None):
+    return SimpleNamespace(photo=photo or [], video=video, animation=animation, document=document)
+
+
+def _file(file_id):
+    return SimpleNamespace(file_id=file_id)
+
+
+@pytest.mark.parametrize(
+    "message, kind, expected",
+    [
+        (_message(video=_file("BAACAgIAAxkDAAIBZ2")), "video", ("video", "BAACAgIAAxkDAAIBZ2")),
+        # Видео, которое Telegram сохранил как анимацию или документ, кэшируется с их типом
+        (_message(animation=_file("CgACAgIAAxkDAAIBaG"), document=_file("CgACAgIAAxkDAAIBaG")), "video",
+         ("animation", "CgACAgIAAxkDAAIBaG")),
+        (_message(document=_file("BQACAgIAAxkDAAIBaW")), "video", ("document", "BQACAgIAAxkDAAIBaW")),
+        (_message(photo=[_file("AgACAgIAAxkDAAIBam_s"), _file("AgACAgIAAxkDAAIBam_m")]), "photo",
+         ("photo", "AgACAgIAAxkDAAIBam_m")),
+        (_message(document=_file("BQACAgIAAxkDAAIBaw")), "document", ("document", "BQACAgIAAxkDAAIBaw")),
+        (_message(), "video", ("video", None)),
+        (None, "photo", ("photo", None)),
+    ],
+)
+def test_sent_media_entry(message, kind, expected):
+    assert download._sent_media_entry(message, kind) == expected
+
+
+def test_cached_inline_results_use_stored_kind():
+    entries = [("video", "v"), ("animation", "a"), ("photo", "p"), ("document", "d")]
+    results = download._cached_inline_results("https://www.tiktok.com/@u/video/7301234567890123456", entries)
+    assert [type(r).__name__ for r in results] == [
+        "InlineQueryResultCachedVideo",
+        "InlineQueryResultCachedMpeg4Gif",
+        "InlineQueryResultCachedPhoto",
+        "InlineQueryResultCachedDocument",
+    ]